@@ -1,7 +1,21 @@
 from argparse import ArgumentParser
+from functools import partial
 import os
+import sys
 
-from utils import api, logger
+from utils import (
+    api,
+    cache,
+    database,
+    file,
+    logger,
+    pack,
+    plan,
+    schedule,
+    server,
+    verify,
+)
+from utils.manifest import Manifest
 from utils.resource import Resource
 
 # Subdir to store the images
@@ -16,25 +30,128 @@ if __name__ == "__main__":
         type=str,
         help="directory to store the data in",
     )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="cache API responses and scraped pages in the given directory",
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="MB",
+        type=int,
+        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+        help=f"how big the cache can get before old responses are removed (defaults to {cache.DEFAULT_MAX_SIZE // (1024 * 1024)})",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        metavar="HOURS",
+        type=float,
+        default=cache.DEFAULT_TTL / 3600,
+        help=f"how long cached responses are used before checking them again (defaults to {cache.DEFAULT_TTL // 3600:.0f})",
+    )
+    parser.add_argument(
+        "-c",
+        "--convert",
+        help="convert the existing data in TARGET_DIR to the storage format and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cost-order",
+        help="estimate what each resource costs first and download the cheapest first",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        metavar="PATH",
+        help="also store everything in an SQLite database at the given path",
+    )
     parser.add_argument(
         "-f",
         "--download-images",
         help="download image files alongside metadata",
         action="store_true",
     )
+    parser.add_argument(
+        "--fields",
+        metavar="FIELDS",
+        help="comma-separated list of fields to fetch (uses the custom profile)",
+    )
+    parser.add_argument(
+        "--format",
+        metavar="FORMAT",
+        choices=[f.value for f in file.StorageFormat],
+        default=file.StorageFormat.JSON.value,
+        help="how to store the data: "
+        + ", ".join(f.value for f in file.StorageFormat)
+        + " (defaults to json)",
+    )
     parser.add_argument(
         "-i",
         "--include",
         metavar="RESOURCES",
         help="which resources to include (defaults to all)",
     )
+    parser.add_argument(
+        "--ingest",
+        help="load the existing data in TARGET_DIR into the database and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="COUNT",
+        type=int,
+        default=1,
+        help="how many resources to download at once (defaults to 1)",
+    )
+    parser.add_argument(
+        "-l",
+        "--log-file",
+        metavar="PATH",
+        help="also write a structured (JSON lines) log to the given file",
+    )
+    parser.add_argument(
+        "--migrate-packs",
+        help="move the existing image data in TARGET_DIR into packs and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--offline",
+        help="only use responses from the --cache, never the network",
+        action="store_true",
+    )
     parser.add_argument(
         "-o",
         "--overwrite-images",
         help="overwrite existing images",
         action="store_true",
     )
+    parser.add_argument(
+        "-p",
+        "--pack-image-data",
+        help="store image data in one pack per thousand galleries instead of a file each",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plan",
+        help="estimate the requests, size and time each resource will take and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PROFILE",
+        choices=[p.value for p in api.FetchProfile],
+        help="which fields to fetch: "
+        + ", ".join(p.value for p in api.FetchProfile)
+        + " (defaults to full)",
+    )
     parser.add_argument("-q", "--quiet", help="prevent all output", action="store_true")
+    parser.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        help="serve the data in TARGET_DIR the same way the API does (and the images in it) until stopped",
+    )
     parser.add_argument(
         "-s",
         "--skip-existing",
@@ -44,12 +161,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "-v", "--verbose", help="show verbose output", action="store_true"
     )
-
-    # Get API key
-
-    if "GB_API_KEY" not in os.environ:
-        logger.fatal("Missing environment variable: GB_API_KEY")
-    api_key = os.environ["GB_API_KEY"]
+    parser.add_argument(
+        "--verify",
+        help="check the files in TARGET_DIR for corruption and exit (corrupt images are downloaded again with --download-images)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="COUNT",
+        type=int,
+        default=api.DEFAULT_WORKERS,
+        help=f"how many requests to run in parallel where possible (defaults to {api.DEFAULT_WORKERS})",
+    )
 
     # Parse arguments
 
@@ -70,24 +194,184 @@ if __name__ == "__main__":
         logger.log_level = logger.Level.ERROR
     if args.verbose:
         logger.log_level = logger.Level.DEBUG
+    if args.workers < 1:
+        logger.fatal("Need at least one worker")
+    if args.jobs < 1:
+        logger.fatal("Need to run at least one job at a time")
+    if args.log_file:
+        logger.open_structured_log(os.path.abspath(args.log_file))
+
+    pack.enabled = args.pack_image_data
+
+    if args.offline and not args.cache:
+        logger.fatal("Need a --cache to work offline from")
+    if args.offline and args.download_images:
+        logger.fatal("Image files aren't cached, so can't be downloaded offline")
+    if args.cache:
+        cache.directory = os.path.abspath(args.cache)
+        cache.ttl = args.cache_ttl * 3600
+        cache.max_size = args.cache_size * 1024 * 1024
+        cache.offline = args.offline
+
+    if args.fields:
+        if args.profile and args.profile != api.FetchProfile.CUSTOM:
+            logger.fatal("--fields can only be used with the custom profile")
+        api.custom_fields = [f.strip() for f in args.fields.split(",")]
+        api.fetch_profile = api.FetchProfile.CUSTOM
+    elif args.profile == api.FetchProfile.CUSTOM:
+        logger.fatal("The custom profile needs a list of --fields")
+    elif args.profile:
+        api.fetch_profile = api.FetchProfile(args.profile)
+
+    file.storage_format = file.StorageFormat(args.format)
+    format_error = file.check_storage_format(file.storage_format)
+    if format_error:
+        logger.fatal(format_error)
 
     target_dir = os.path.abspath(args.target)
 
-    # Do the thing
+    if args.ingest and not args.database:
+        logger.fatal("Need a --database to ingest into")
+    if args.database:
+        database.open_database(os.path.abspath(args.database))
 
-    for resource in resources:
-        resource.download_data(target_dir, api_key, args.skip_existing)
+    # Modes which only work on what's already been downloaded
 
-        if args.download_images:
-            images = resource.extract_images(target_dir)
-            if len(images) == 0:
-                logger.warn(f"Got 0 images for {resource}")
-                continue
+    if args.convert:
+        logger.info(f"Converting data in {target_dir} to {file.storage_format}...")
+        file.convert_data(
+            target_dir, file.storage_format, [os.path.join(target_dir, IMAGE_DIR)]
+        )
+        logger.success("Done!")
+        sys.exit(0)
 
-            logger.info(f"Downloading {len(images)} images...")
-            downloaded, skipped, errors = api.download_images(
-                images, os.path.join(target_dir, IMAGE_DIR), args.overwrite_images
-            )
+    if args.migrate_packs:
+        image_data_dir = os.path.join(target_dir, Resource.IMAGE_DATA.value)
+        if not os.path.isdir(image_data_dir):
+            logger.fatal(f"No image data to pack in: {image_data_dir}")
+        logger.info(f"Moving image data in {image_data_dir} into packs...")
+        moved = pack.migrate(image_data_dir)
+        logger.success(f"Packed {moved} galleries")
+        sys.exit(0)
+
+    if args.verify:
+        logger.info(f"Verifying files in {target_dir}...")
+        image_dir = os.path.join(target_dir, IMAGE_DIR)
+        checked, skipped, corrupt = verify.verify(target_dir, image_dir, args.workers)
+        logger.success(
+            f"Checked {checked} files ({skipped} unchanged, {len(corrupt)} corrupt)"
+        )
+
+        images = [
+            api.IMAGE_URL_PREFIXES[0]
+            + os.path.relpath(path, image_dir).replace(os.sep, "/")
+            for path in corrupt
+            if path.startswith(image_dir + os.sep)
+        ]
+        if images and args.download_images:
+            logger.info(f"Downloading {len(images)} corrupt images again...")
+            with Manifest(target_dir) as manifest:
+                downloaded, skipped, errors = api.download_images(
+                    images, image_dir, True, manifest
+                )
             logger.success(
                 f"Saved {downloaded} images ({skipped} skipped, {errors} errors)"
             )
+        elif corrupt:
+            logger.info(
+                "Corrupt files have been moved aside and will be downloaded again on the next run"
+            )
+        sys.exit(0)
+
+    if args.ingest:
+        logger.info(f"Loading data from {target_dir} into {args.database}...")
+        count = database.ingest(target_dir, [os.path.join(target_dir, IMAGE_DIR)])
+        logger.success(f"Stored {count} items")
+        sys.exit(0)
+
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        if not port.isdigit():
+            logger.fatal(f"Invalid port to serve on: {port}")
+        logger.info(f"Loading data from {target_dir}...")
+        server.serve(
+            target_dir,
+            os.path.join(target_dir, IMAGE_DIR),
+            host or "127.0.0.1",
+            int(port),
+        )
+        sys.exit(0)
+
+    # Get API key
+
+    if "GB_API_KEY" not in os.environ and not args.offline:
+        logger.fatal("Missing environment variable: GB_API_KEY")
+    api_key = os.environ.get("GB_API_KEY", "")  # not part of what's cached
+
+    # Work out what it's going to cost
+
+    if args.plan or args.cost_order:
+        with Manifest(target_dir) as manifest:
+            estimates = plan.estimate(
+                resources,
+                target_dir,
+                api_key,
+                args.skip_existing,
+                args.workers,
+                manifest,
+            )
+        if args.plan:
+            plan.log_plan(estimates)
+            sys.exit(0)
+        resources = plan.order_by_cost(estimates)
+        logger.info(f"Downloading in order: {', '.join(resources)}")
+
+    # Do the thing
+
+    # The manifest keeps track of what the images looked like when they were downloaded
+    with Manifest(target_dir) as manifest:
+        jobs = []
+        image_job = None
+        for resource in resources:
+            after = []
+            if resource == Resource.IMAGES:
+                # The galleries come from the image tags of everything else
+                after = [
+                    r.value
+                    for r in resources
+                    if r not in [Resource.IMAGES, Resource.IMAGE_DATA]
+                ]
+            jobs.append(
+                schedule.Job(
+                    resource.value,
+                    partial(
+                        resource.download_data,
+                        target_dir,
+                        api_key,
+                        args.skip_existing,
+                        args.workers,
+                        manifest,
+                    ),
+                    after,
+                )
+            )
+
+            if args.download_images:
+                # One resource's images at a time, since they can share files
+                after = [resource.value] + ([image_job] if image_job else [])
+                image_job = f"{resource.value} images"
+                jobs.append(
+                    schedule.Job(
+                        image_job,
+                        partial(
+                            resource.download_images,
+                            target_dir,
+                            os.path.join(target_dir, IMAGE_DIR),
+                            args.overwrite_images,
+                            manifest,
+                        ),
+                        after,
+                    )
+                )
+
+        schedule.run_jobs(jobs, args.jobs, api.stop)
@@ -1,12 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+from enum import StrEnum
+import json
 import os
 import re
-from time import sleep
+from threading import Event, Lock
+from time import monotonic
 from typing import Any
 
 import requests
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 
-from utils import logger
+from utils import cache, logger
+from utils.manifest import Manifest
 
 
 # Base URL for the API
@@ -38,6 +43,9 @@ IMAGE_URL_PREFIXES = [
 # If unable to download original size, fallback to this size
 IMAGE_SIZE_FALLBACK = "screen_kubrick"
 
+# Extension of images that are still being downloaded
+PARTIAL_IMAGE_EXTENSION = ".part"
+
 # How many times to retry a failed GET request
 MAX_RETRIES = 10
 
@@ -53,11 +61,90 @@ RETRY_DELAY_RATE_LIMIT = 8
 # How many items to request per page (max 100)
 PAGE_REQUEST_LIMIT = 100
 
+# How many requests to have in flight at once when fetching in parallel
+DEFAULT_WORKERS = 4
+
+# Only split a resource's pages between workers if it has at least this many left
+SPLIT_MIN_PAGES = 10
+
+# Fields the index profile asks for: enough to identify items, see if they've changed,
+# and find their images
+INDEX_FIELDS = [
+    "id",
+    "guid",
+    "name",
+    "api_detail_url",
+    "site_detail_url",
+    "date_added",
+    "date_last_updated",
+    "image",
+    "image_tags",
+]
+
 
 class ApiError(Exception):
     """Generic API error."""
 
 
+class Stopped(KeyboardInterrupt):
+    """Raised by requests made after stop() has been called."""
+
+
+class FetchProfile(StrEnum):
+    """Which fields to request for each item from the API."""
+
+    FULL = "full"  # everything
+    INDEX = "index"  # just the INDEX_FIELDS (plus a few per resource)
+    CUSTOM = "custom"  # whatever is in custom_fields
+
+
+class _RateLimiter:
+    """Spaces out requests so they start at least `delay` seconds apart, across all threads."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._lock = Lock()
+        self._next_slot = 0.0
+
+    def pause(self, seconds: float):
+        """Hold back every request for the given number of seconds."""
+        with self._lock:
+            self._next_slot = max(self._next_slot, monotonic() + seconds)
+
+    def wait(self):
+        """Block until the next request is allowed to go out."""
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.delay
+
+        if slot > now:
+            _sleep(slot - now)
+
+
+# Global limit shared by everything that hits the API
+_api_limiter = _RateLimiter(REQUEST_DELAY)
+
+# Set once everything should give up (see stop)
+_stopping = Event()
+
+fetch_profile: FetchProfile = FetchProfile.FULL
+
+custom_fields: list[str] = []
+
+
+def _check_stopped():
+    """Give up (by raising Stopped) if stop() has been called."""
+    if _stopping.is_set():
+        raise Stopped()
+
+
+def _sleep(seconds: float):
+    """Sleep, giving up early if stop() is called in the meantime."""
+    if _stopping.wait(seconds):
+        raise Stopped()
+
+
 def _format_dict(data: dict | None, connect: str, join: str) -> str:
     """Format a dict for output."""
     if data is None:
@@ -66,21 +153,71 @@ def _format_dict(data: dict | None, connect: str, join: str) -> str:
     return join.join([f"{k}{connect}{v}" for k, v in data.items()])
 
 
-def _get(url: str, params: dict | None = None, as_json: bool = True) -> Any:
+def _paged_params(api_key: str, offset: int, field_list: list[str] | None) -> dict:
+    """Build the parameters for a page of a paged resource."""
+    params = {
+        "api_key": api_key,
+        "format": "json",
+        "limit": PAGE_REQUEST_LIMIT,
+        "offset": offset,
+    }
+    if field_list:
+        params["field_list"] = ",".join(field_list)
+
+    return params
+
+
+def _get(
+    url: str,
+    params: dict | None = None,
+    as_json: bool = True,
+    limiter: _RateLimiter | None = None,
+) -> Any:
     """Make a GET request, returning the response parsed as JSON or text."""
+    return _get_with_size(url, params, as_json, limiter)[0]
+
+
+def _get_with_size(
+    url: str,
+    params: dict | None = None,
+    as_json: bool = True,
+    limiter: _RateLimiter | None = None,
+) -> tuple[Any, int]:
+    """Make a GET request, returning the parsed response and how many bytes it was.
+
+    If the cache is enabled, fresh cached responses are used without going near the network
+    (or the rate limiter), and stale ones are checked with the server before being used again.
+    """
+    _check_stopped()
+    cached = cache.get(url, params) if cache.enabled() else None
+    if cached and (cache.offline or cached.fresh):
+        logger.debug(lambda: f"Cached: {url} " + _format_dict(params, "=", "&"))
+        body = cached.body
+        return (json.loads(body) if as_json else body), len(body)
+    if cache.offline:
+        raise ApiError(f"Not in the cache (and working offline): {url}")
+
     tries = 0
     while tries < MAX_RETRIES:
         tries += 1
 
+        if limiter:
+            limiter.wait()
+
         # Headers sent with each request
         headers = {
             "User-Agent": USER_AGENT,
         }
         if as_json:
             headers["Accept"] = "application/json"
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
 
+        # Only build the message if it's going to be shown, this runs a lot
         logger.debug(
-            f"GET {url} "
+            lambda: f"GET {url} "
             + _format_dict(params, "=", "&")
             + " ("
             + _format_dict(headers, ":", " ")
@@ -88,77 +225,172 @@ def _get(url: str, params: dict | None = None, as_json: bool = True) -> Any:
         )
 
         response = requests.get(url, params=params, headers=headers)
+        size = len(response.content)
+        logger.record_request(size)
+        if response.status_code == 304 and cached:
+            cache.refresh(cached)
+            body = cached.body
+            return (json.loads(body) if as_json else body), len(body)
+
         if response.status_code == 200:
-            return response.json() if as_json else response.text  # yay!
+            if cache.enabled():
+                cache.put(
+                    url,
+                    params,
+                    response.text,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+            return (response.json() if as_json else response.text), size  # yay!
 
         if response.status_code == 420:
             logger.warn(
                 f"We've gone over the limit! Waiting {RETRY_DELAY_RATE_LIMIT} minutes to try again..."
             )
-            sleep(RETRY_DELAY_RATE_LIMIT * 60)
+            if limiter:  # hold back the other workers too
+                limiter.pause(RETRY_DELAY_RATE_LIMIT * 60)
+            else:
+                _sleep(RETRY_DELAY_RATE_LIMIT * 60)
         else:
             logger.error(
                 f"Unexpected response ({response.status_code}): {response.text}"
             )
-            sleep(RETRY_DELAY * 60)
+            _sleep(RETRY_DELAY * 60)
 
     raise ApiError(f"Unable to fetch resource after {MAX_RETRIES} retries")
-    return {}
+
+
+def _fetch_image(url: str, target_file: str, manifest: Manifest | None) -> bool:
+    """Download an image into place, returning False if it hasn't changed since last time.
+
+    The image is written to a partial file first (which is resumed with a Range request if
+    it's there from an interrupted download) and only moved into place once it's complete.
+    If the image was downloaded before, the stored ETag/Last-Modified are sent so the server
+    can tell us it hasn't changed.
+    """
+    _check_stopped()
+    partial_file = target_file + PARTIAL_IMAGE_EXTENSION
+    entry = (manifest.get(target_file) if manifest else None) or {}
+    headers = {
+        "User-Agent": USER_AGENT,
+    }
+
+    if os.path.isfile(target_file):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    resume_from = os.path.getsize(partial_file) if os.path.isfile(partial_file) else 0
+    if resume_from:
+        headers["Range"] = f"bytes={resume_from}-"
+        # Only resume if the partial file is from the same version of the image
+        if entry.get("partial_validator"):
+            headers["If-Range"] = entry["partial_validator"]
+
+    with requests.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            logger.record_request(0)
+            return False
+
+        if r.status_code == 416 and resume_from:  # the partial file is no good
+            os.remove(partial_file)
+            return _fetch_image(url, target_file, manifest)
+
+        r.raise_for_status()
+
+        validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+        if manifest and validator:
+            manifest.update(target_file, partial_validator=validator)
+
+        size = 0
+        mode = "ab" if r.status_code == 206 else "wb"
+        with open(partial_file, mode) as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                _check_stopped()  # what's written so far is resumed next time
+                f.write(chunk)
+                size += len(chunk)
+        logger.record_request(size)
+
+        os.replace(partial_file, target_file)
+        if manifest:
+            manifest.update(
+                target_file,
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+                partial_validator=None,
+            )
+
+    return True
 
 
 def download_images(
-    images: list[str], target_dir: str, overwrite_existing: bool
+    images: list[str],
+    target_dir: str,
+    overwrite_existing: bool,
+    manifest: Manifest | None = None,
 ) -> tuple[int, int, int]:
-    """Download a list of images to the target dir, returning how many were downloaded, skipped, and errored."""
+    """Download a list of images to the target dir, returning how many were downloaded, skipped, and errored.
+
+    If there's a manifest, it's used to resume interrupted downloads and to avoid downloading
+    images again when they haven't changed (those count as skipped).
+    """
     downloaded = 0
     skipped = 0
     errors = 0
-    for url in images:
-        for find, replace in IMAGE_URL_MAPPING.items():
-            url = url.replace(find, replace)
-
-        image_url_prefix = None
-        for prefix in IMAGE_URL_PREFIXES:
-            if url.startswith(prefix):
-                image_url_prefix = prefix
-                break
-
-        if not image_url_prefix:
-            logger.warn(f"Unhandled image URL: {url}")
-            continue
-
-        target_file = os.path.join(target_dir, url.replace(image_url_prefix, ""))
-
-        # Remove any junk after the file extension
-        _, ext = os.path.splitext(target_file)
-        clean_ext = re.sub(r"^(\.[\w]+)(.*?)$", r"\1", ext)
-        target_file = target_file.replace(ext, clean_ext)
-
-        file_dir = os.path.dirname(target_file)
-        if not os.path.isdir(file_dir):
-            os.makedirs(file_dir, exist_ok=True)
-
-        if not overwrite_existing and os.path.isfile(target_file):
-            logger.debug(f"Skipping existing image: {target_file}")
-            skipped += 1
-            continue
-
-        logger.debug(f"Downloading: {url}")
-        try:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(target_file, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            downloaded += 1
-            sleep(IMAGE_DELAY)
-        except HTTPError as e:
-            logger.error(f"Error when downloading file: {str(e)}")
-            errors += 1
-
-            # Try with a different sized image
-            if url.find("/original/") != -1:
-                images.append(url.replace("/original/", f"/{IMAGE_SIZE_FALLBACK}/"))
+    with logger.progress("Downloading images", len(images)) as progress:
+        for url in images:
+            progress.advance()
+
+            for find, replace in IMAGE_URL_MAPPING.items():
+                url = url.replace(find, replace)
+
+            image_url_prefix = None
+            for prefix in IMAGE_URL_PREFIXES:
+                if url.startswith(prefix):
+                    image_url_prefix = prefix
+                    break
+
+            if not image_url_prefix:
+                logger.warn(f"Unhandled image URL: {url}")
+                continue
+
+            target_file = os.path.join(target_dir, url.replace(image_url_prefix, ""))
+
+            # Remove any junk after the file extension
+            _, ext = os.path.splitext(target_file)
+            clean_ext = re.sub(r"^(\.[\w]+)(.*?)$", r"\1", ext)
+            target_file = target_file.replace(ext, clean_ext)
+
+            file_dir = os.path.dirname(target_file)
+            if not os.path.isdir(file_dir):
+                os.makedirs(file_dir, exist_ok=True)
+
+            if not overwrite_existing and os.path.isfile(target_file):
+                logger.debug(f"Skipping existing image: {target_file}")
+                skipped += 1
+                continue
+
+            logger.debug(f"Downloading: {url}")
+            try:
+                if _fetch_image(url, target_file, manifest):
+                    downloaded += 1
+                else:
+                    logger.debug(f"Image hasn't changed: {target_file}")
+                    skipped += 1
+                _sleep(IMAGE_DELAY)
+            except HTTPError as e:
+                logger.error(f"Error when downloading file: {str(e)}")
+                errors += 1
+
+                # Try with a different sized image
+                if url.find("/original/") != -1:
+                    images.append(url.replace("/original/", f"/{IMAGE_SIZE_FALLBACK}/"))
+                    progress.total = len(images)
+            except RequestException as e:
+                # Whatever made it into the partial file is picked up next time
+                logger.error(f"Error when downloading file: {str(e)}")
+                errors += 1
 
     return downloaded, skipped, errors
 
@@ -168,7 +400,12 @@ def get_page(url: str, params: dict = {}) -> str:
     return _get(url, params, as_json=False)
 
 
-def get_individualized_resource(resource: str, max_count: int, api_key: str) -> list:
+def get_individualized_resource(
+    resource: str,
+    max_count: int,
+    api_key: str,
+    progress: logger.Progress | None = None,
+) -> list:
     """Get a resource that needs to be fetched one entry at a time."""
     base_url = f"{BASE_URL}/{resource}"
     params = {
@@ -180,7 +417,7 @@ def get_individualized_resource(resource: str, max_count: int, api_key: str) ->
     num = 1
     while True:
         url = f"{base_url}/{num}/"
-        data = _get(url, params)
+        data = _get(url, params, limiter=_api_limiter)
 
         if "error" in data and data["error"] != "OK":
             logger.error(f"Received error for /{resource}/{num}: {data['error']}")
@@ -188,12 +425,13 @@ def get_individualized_resource(resource: str, max_count: int, api_key: str) ->
         if "results" in data and data["results"]:
             results.append(data["results"])
 
+        if progress:
+            progress.advance()
+
         num += 1
         if num > max_count:
             break
 
-        sleep(REQUEST_DELAY)
-
     return results
 
 
@@ -225,30 +463,75 @@ def get_image_data(object_id: str) -> list:
     return images
 
 
-def get_paged_resource(resource: str, api_key: str) -> list:
-    """Get a resource that's paged with limit/offset parameters."""
+def get_paged_resource(
+    resource: str,
+    api_key: str,
+    progress: logger.Progress | None = None,
+    field_list: list[str] | None = None,
+    stats: dict | None = None,
+    workers: int = 1,
+) -> list:
+    """Get a resource that's paged with limit/offset parameters.
+
+    Requests go through the global rate limiter, so this is safe to call from several threads at once.
+    With more than one worker, long resources have their pages after the first fetched in parallel.
+
+    If a field list is given only those fields are requested. How many requests and bytes it
+    took are put into `stats`.
+    """
+    url = f"{BASE_URL}/{resource}/"
     resources = []
     offset = 0
+    downloaded = 0
+    requests_made = 0
     while True:
-        url = f"{BASE_URL}/{resource}/"
-        params = {
-            "api_key": api_key,
-            "format": "json",
-            "limit": PAGE_REQUEST_LIMIT,
-            "offset": offset,
-        }
-
-        data = _get(url, params)
+        params = _paged_params(api_key, offset, field_list)
+        data, size = _get_with_size(url, params, limiter=_api_limiter)
+        downloaded += size
+        requests_made += 1
         if not data["results"] or len(data["results"]) == 0:
             break
 
         resources += data["results"]
+        if progress:
+            progress.total = data.get("number_of_total_results")
+            progress.advance(len(data["results"]))
         if "number_of_total_results" in data:
             if len(resources) == data["number_of_total_results"]:
                 break  # trust that we're done here
 
         offset += PAGE_REQUEST_LIMIT
-        sleep(REQUEST_DELAY)
+
+        # Now we know how long it is, split the rest of the pages between the workers
+        remaining = range(
+            offset, data.get("number_of_total_results") or 0, PAGE_REQUEST_LIMIT
+        )
+        if workers > 1 and len(remaining) >= SPLIT_MIN_PAGES:
+            logger.debug(f"Splitting {len(remaining)} pages of {resource}")
+            with ThreadPoolExecutor(
+                max_workers=workers,
+                initializer=logger.hold,
+                initargs=logger.inherit(),
+            ) as executor:
+                pages = executor.map(
+                    lambda page_offset: _get_with_size(
+                        url,
+                        _paged_params(api_key, page_offset, field_list),
+                        limiter=_api_limiter,
+                    ),
+                    remaining,
+                )
+                for page, size in pages:  # in order, whichever finishes first
+                    downloaded += size
+                    requests_made += 1
+                    resources += page["results"] or []
+                    if progress:
+                        progress.advance(len(page["results"] or []))
+            break
+
+    if stats is not None:
+        stats["requests"] = requests_made
+        stats["bytes"] = downloaded
 
     return resources
 
@@ -262,8 +545,36 @@ def get_resource(resource: str, api_key: str) -> list:
         "limit": PAGE_REQUEST_LIMIT,
     }
 
-    data = _get(url, params)
+    data = _get(url, params, limiter=_api_limiter)
     if not data["results"] or len(data["results"]) == 0:
         return []
 
     return data["results"]
+
+
+def probe_paged_resource(
+    resource: str, api_key: str, field_list: list[str] | None = None
+) -> tuple[int | None, int, int, float]:
+    """Fetch the first page of a resource, returning the total number of results, how many bytes
+    and results the page had, and how long it took.
+    """
+    _api_limiter.wait()  # so the wait isn't counted in how long it took
+    started = monotonic()
+    data, size = _get_with_size(
+        f"{BASE_URL}/{resource}/", _paged_params(api_key, 0, field_list)
+    )
+    elapsed = monotonic() - started
+
+    return (
+        data.get("number_of_total_results"),
+        size,
+        len(data["results"] or []),
+        elapsed,
+    )
+
+
+def stop():
+    """Make every request from now on (in any thread) give up by raising Stopped, including
+    ones that are waiting on the rate limit or a retry.
+    """
+    _stopping.set()
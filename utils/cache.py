@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import json
+import os
+from threading import Lock, get_ident
+from time import time
+
+from utils import logger
+
+
+# Compression level used for cached bodies (1-9, lower is faster)
+COMPRESS_LEVEL = 6
+
+# How long (in seconds) a cached response is used before checking it with the server again
+DEFAULT_TTL = 24 * 60 * 60
+
+# How big (in bytes) the cache can get before the oldest responses are removed
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# How much of the maximum size is left once the cache has been cut down
+EVICT_TO = 0.9
+
+# Parameters that don't change the response (so aren't part of the key)
+IGNORED_PARAMS = ["api_key"]
+
+# Where responses are cached (None meaning they aren't)
+directory: str | None = None
+
+# Only use cached responses, never the network
+offline: bool = False
+
+ttl: float = DEFAULT_TTL
+
+max_size: int = DEFAULT_MAX_SIZE
+
+
+class Entry:
+    """A cached response."""
+
+    def __init__(
+        self,
+        path: str,
+        body: str,
+        stored_at: float,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ):
+        self.path = path
+        self.body = body
+        self.stored_at = stored_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def fresh(self) -> bool:
+        """Whether the response can be used without checking with the server."""
+        return time() - self.stored_at < ttl
+
+
+_lock = Lock()
+_size: int | None = None
+
+
+def _path_for(url: str, params: dict | None) -> str:
+    """Get where the response for a request is cached."""
+    if directory is None:
+        raise RuntimeError("The cache is not enabled")
+
+    params = {k: str(v) for k, v in (params or {}).items() if k not in IGNORED_PARAMS}
+    key = hashlib.sha256(json.dumps([url, params], sort_keys=True).encode()).hexdigest()
+    return os.path.join(directory, key[:2], key)
+
+
+def _list_entries() -> list[tuple[float, int, str]]:
+    """Get the modification time, size and path of every cached response."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(directory or ""):
+        for filename in filenames:
+            if filename.endswith(".tmp"):
+                continue  # still being written
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # evicted by someone else in the meantime
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    return entries
+
+
+def _evict():
+    """Remove the oldest responses until the cache is back under its maximum size."""
+    global _size
+
+    if _size is None:
+        _size = sum(size for _, size, _ in _list_entries())
+    if _size <= max_size:
+        return
+
+    removed = 0
+    for _, size, path in sorted(_list_entries()):
+        if _size <= max_size * EVICT_TO:
+            break
+        os.remove(path)
+        _size -= size
+        removed += 1
+
+    logger.debug(f"Removed {removed} old responses from the cache")
+
+
+def enabled() -> bool:
+    """Check whether responses are being cached."""
+    return directory is not None
+
+
+def get(url: str, params: dict | None = None) -> Entry | None:
+    """Get the cached response for a request, if there is one."""
+    path = _path_for(url, params)
+    try:
+        stored_at = os.path.getmtime(path)
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError):
+        logger.debug(f"Ignoring broken cache entry: {path}")
+        return None
+
+    return Entry(
+        path, record["body"], stored_at, record.get("etag"), record.get("last_modified")
+    )
+
+
+def put(
+    url: str,
+    params: dict | None,
+    body: str,
+    etag: str | None = None,
+    last_modified: str | None = None,
+):
+    """Cache the response to a request."""
+    global _size
+
+    path = _path_for(url, params)
+    data = gzip.compress(
+        json.dumps(
+            {"url": url, "etag": etag, "last_modified": last_modified, "body": body},
+            ensure_ascii=False,
+        ).encode(),
+        compresslevel=COMPRESS_LEVEL,
+    )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+
+    with _lock:
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        os.replace(temp_path, path)
+        if _size is not None:
+            _size += len(data) - old_size
+        _evict()
+
+
+def refresh(entry: Entry):
+    """Mark a cached response as fresh again (because the server said it hasn't changed)."""
+    try:
+        os.utime(entry.path)
+    except FileNotFoundError:
+        pass  # evicted in the meantime
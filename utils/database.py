@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from threading import Lock
+
+from utils import file, logger, pack
+
+
+# Fields pulled out of each item into their own (indexed) columns
+INDEXED_FIELDS = ["id", "guid", "name", "date_last_updated"]
+
+# Fields that identify an item which doesn't have an ID (e.g. the images in a gallery)
+KEY_FIELDS = ["id", "original_url", "original", "guid"]
+
+# How many items to insert per transaction when ingesting existing files
+INGEST_BATCH_SIZE = 10000
+
+# Table names have to look like this (they come from resource names)
+TABLE_NAME_RE = r"^[a-z_]+$"
+
+
+_connection: sqlite3.Connection | None = None
+_lock = Lock()
+_tables: set[str] = set()
+
+
+def _key(item: dict, data: str) -> str:
+    """Get what identifies an item within its source, so saving it again replaces it."""
+    for field in KEY_FIELDS:
+        if item.get(field) is not None:
+            return f"{field}:{item[field]}"
+
+    return "sha1:" + hashlib.sha1(data.encode()).hexdigest()
+
+
+def _row(item: dict, source: str) -> tuple:
+    """Turn an item into a row for inserting."""
+    data = json.dumps(item, ensure_ascii=False, separators=(",", ":"))
+    return (
+        source,
+        _key(item, data),
+        item.get("id"),
+        item.get("guid"),
+        item.get("name") or item.get("title"),
+        item.get("date_last_updated"),
+        data,
+    )
+
+
+def _ensure_table(connection: sqlite3.Connection, table: str):
+    """Create the table for a resource (and its indexes) if it doesn't exist yet."""
+    if table in _tables:
+        return
+
+    if not re.match(TABLE_NAME_RE, table):
+        raise ValueError(f"Invalid table name: {table}")
+
+    connection.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+            source TEXT NOT NULL DEFAULT '',
+            key TEXT NOT NULL,
+            id INTEGER,
+            guid TEXT,
+            name TEXT,
+            date_last_updated TEXT,
+            data TEXT NOT NULL,
+            UNIQUE (source, key)
+        )""")
+    for field in INDEXED_FIELDS:
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_{field} ON {table} ({field})"
+        )
+    _tables.add(table)
+
+
+def _upsert(connection: sqlite3.Connection, table: str, rows: list[tuple]):
+    """Insert rows, replacing any that are already there for the same item."""
+    connection.executemany(
+        f"""INSERT INTO {table} (source, key, id, guid, name, date_last_updated, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source, key) DO UPDATE SET
+                id = excluded.id,
+                guid = excluded.guid,
+                name = excluded.name,
+                date_last_updated = excluded.date_last_updated,
+                data = excluded.data""",
+        rows,
+    )
+
+
+def _table_for(path: str, root_dir: str) -> tuple[str, str] | None:
+    """Work out the table and source for a data file in the mirror."""
+    base_path = file.data_base(os.path.relpath(path, root_dir))
+    if base_path is None:
+        return None
+
+    parts = base_path.split(os.sep)
+    if not re.match(TABLE_NAME_RE, parts[0]):
+        return None
+
+    # e.g. games.json, images/3030-1.json or image_data/12/12345.json
+    return parts[0], parts[-1] if len(parts) > 1 else ""
+
+
+def close_database():
+    """Close the database, if it's open."""
+    global _connection
+
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+            _tables.clear()
+
+
+def get(table: str, id: int | None = None, guid: str | None = None) -> dict | None:
+    """Look up a single item by its ID or GUID."""
+    if id is not None:
+        results = query(table, {"id": id}, limit=1)
+    elif guid is not None:
+        results = query(table, {"guid": guid}, limit=1)
+    else:
+        raise ValueError("Need either an ID or a GUID to look up")
+
+    return results[0] if results else None
+
+
+def ingest(root_dir: str, exclude: list[str] = []) -> int:
+    """Load every data file in the mirror into the database, returning how many items went in."""
+    if _connection is None:
+        raise RuntimeError("The database has not been opened")
+
+    files = []
+    packs = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in exclude]
+        files += [os.path.join(dirpath, f) for f in filenames if file.data_base(f)]
+        packs += [
+            os.path.join(dirpath, f)
+            for f in filenames
+            if f.endswith(pack.PACK_EXTENSION)
+        ]
+
+    total = 0
+    with logger.progress("Ingesting", len(files) + len(packs)) as progress:
+        for path in sorted(files):
+            progress.advance()
+            target = _table_for(path, root_dir)
+            if target is None:
+                continue
+
+            table, source = target
+            batch = []
+            for item in file.iter_data_file(path):
+                if not isinstance(item, dict):
+                    continue
+                batch.append(item)
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    total += save_items(table, batch, source)
+                    batch = []
+            total += save_items(table, batch, source)
+
+        for path in sorted(packs):
+            progress.advance()
+            table = os.path.relpath(path, root_dir).split(os.sep)[0]
+            for gallery_id, items in pack.Pack(path):
+                total += save_items(table, items, str(gallery_id))
+
+    return total
+
+
+def open_database(path: str):
+    """Open (creating if needed) the database that items get written to."""
+    global _connection
+
+    close_database()
+    with _lock:
+        logger.debug(f"Opening database: {path}")
+        _connection = sqlite3.connect(path, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode = WAL")
+        _connection.execute("PRAGMA synchronous = NORMAL")
+
+
+def query(
+    table: str,
+    where: dict | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+) -> list[dict]:
+    """Get the items from a table matching the given indexed fields."""
+    if _connection is None:
+        raise RuntimeError("The database has not been opened")
+    if not re.match(TABLE_NAME_RE, table):
+        raise ValueError(f"Invalid table name: {table}")
+
+    where = where or {}
+    for field in where:
+        if field not in INDEXED_FIELDS + ["source"]:
+            raise ValueError(f"Can only query by: {', '.join(INDEXED_FIELDS)}")
+
+    sql = f"SELECT data FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(f"{field} = ?" for field in where)
+    sql += " ORDER BY rowid LIMIT ? OFFSET ?"
+
+    with _lock:
+        rows = _connection.execute(
+            sql, list(where.values()) + [limit if limit is not None else -1, offset]
+        ).fetchall()
+
+    return [json.loads(row[0]) for row in rows]
+
+
+def save_items(table: str, items: list, source: str = "") -> int:
+    """Insert or update items in a single transaction, returning how many were written."""
+    if _connection is None or not items:
+        return 0
+
+    rows = [_row(item, source) for item in items if isinstance(item, dict)]
+    with _lock, _connection:
+        _ensure_table(_connection, table)
+        _upsert(_connection, table, rows)
+
+    return len(rows)
@@ -1,29 +1,236 @@
+from enum import StrEnum
+import gzip
+import io
 import json
 import os
+from time import perf_counter
+from typing import Iterator
 
 from utils import logger
 
 
-def list_files(source_dir: str, extension: str) -> list[str]:
-    """Get a list of files in the directory that are of the given extension."""
+try:
+    import zstandard
+except ImportError:  # optional, only needed for the zstd format
+    zstandard = None  # type: ignore
+
+
+# Compression level used for gzip files (1-9, lower is faster)
+GZIP_LEVEL = 6
+
+# Compression level used for zstd files (1-22, lower is faster)
+ZSTD_LEVEL = 10
+
+
+class StorageFormat(StrEnum):
+    """How resource data is stored on disk."""
+
+    JSON = "json"  # pretty-printed JSON (the original format)
+    COMPACT = "compact"  # JSON without any whitespace
+    GZIP = "gzip"  # gzip-compressed JSON Lines
+    ZSTD = "zstd"  # zstd-compressed JSON Lines
+
+    @property
+    def extension(self) -> str:
+        """The file extension for this format."""
+        return STORAGE_EXTENSIONS[self]
+
+    @classmethod
+    def from_path(cls, path: str) -> "StorageFormat | None":
+        """Work out the format of a file from its name (JSON and compact JSON look the same)."""
+        for storage_format, extension in STORAGE_EXTENSIONS.items():
+            if path.endswith(extension):
+                return storage_format
+
+        return None
+
+
+STORAGE_EXTENSIONS: dict[StorageFormat, str] = {
+    StorageFormat.JSON: ".json",
+    StorageFormat.COMPACT: ".json",
+    StorageFormat.GZIP: ".jsonl.gz",
+    StorageFormat.ZSTD: ".jsonl.zst",
+}
+
+storage_format: StorageFormat = StorageFormat.JSON
+
+
+def _open_lines(path: str, mode: str, storage: StorageFormat) -> io.TextIOWrapper:
+    """Open a compressed JSON Lines file as text."""
+    if storage == StorageFormat.GZIP:
+        return io.TextIOWrapper(
+            gzip.GzipFile(path, mode + "b", compresslevel=GZIP_LEVEL), encoding="utf-8"
+        )
+
+    if zstandard is None:
+        raise RuntimeError("Reading or writing zstd files needs the zstandard package")
+
+    if mode == "w":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return io.TextIOWrapper(
+            compressor.stream_writer(open(path, "wb"), closefd=True), encoding="utf-8"
+        )
+
+    decompressor = zstandard.ZstdDecompressor()
+    return io.TextIOWrapper(
+        decompressor.stream_reader(open(path, "rb"), closefd=True), encoding="utf-8"
+    )
+
+
+def check_storage_format(value: StorageFormat) -> str | None:
+    """Check that a storage format can be used, returning the reason if not."""
+    if value == StorageFormat.ZSTD and zstandard is None:
+        return "The zstd format needs the zstandard package (pip install zstandard)"
+
+    return None
+
+
+def data_base(path: str) -> str | None:
+    """Strip the data file extension from a path (or None if it's not a data file)."""
+    storage = StorageFormat.from_path(path)
+    if storage is None:
+        return None
+
+    return path[: -len(storage.extension)]
+
+
+def find_data_file(base_path: str) -> str | None:
+    """Find the data file for a path without an extension, preferring the current format."""
+    extensions = [storage_format.extension] + list(STORAGE_EXTENSIONS.values())
+    for extension in extensions:
+        if os.path.isfile(base_path + extension):
+            return base_path + extension
+
+    return None
+
+
+def iter_data_file(path: str) -> Iterator:
+    """Go through the items in a data file of any format."""
+    logger.debug(f"Loading data from: {path}")
+    storage = StorageFormat.from_path(path)
+    if storage is None:
+        raise ValueError(f"Not a data file: {path}")
+
+    if storage.extension == STORAGE_EXTENSIONS[StorageFormat.JSON]:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+
+    with _open_lines(path, "r", storage) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def list_data_files(source_dir: str) -> list[str]:
+    """Get a list of data files (of any format) in the directory."""
     found = []
     for dirpath, dirnames, filenames in os.walk(source_dir):
         for file in filenames:
-            _, ext = os.path.splitext(file)
-            if ext == f".{extension}":
+            if data_base(file) is not None:
                 found.append(os.path.join(dirpath, file))
 
     return found
 
 
-def load_json_file(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        logger.debug(f"Loading data from: {path}")
-        return json.load(f)
+def load_data(base_path: str) -> list:
+    """Load the data stored for a path without an extension, whatever its format."""
+    path = find_data_file(base_path)
+    if path is None:
+        raise FileNotFoundError(f"No data file found for: {base_path}")
+
+    return list(iter_data_file(path))
+
+
+def save_data(data: list, base_path: str, storage: StorageFormat | None = None) -> str:
+    """Save data in the current (or given) storage format, returning the path written.
+
+    The file is written next to its final location and then moved into place, and any
+    copies of the same data in other formats are removed.
+    """
+    storage = storage or storage_format
+    path = base_path + storage.extension
+    temp_path = path + ".tmp"
+    logger.debug(f"Writing data to: {path}")
+
+    if storage == StorageFormat.JSON:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+    elif storage == StorageFormat.COMPACT:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    else:
+        with _open_lines(temp_path, "w", storage) as f:
+            for item in data:
+                f.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+
+    os.replace(temp_path, path)
+
+    for extension in set(STORAGE_EXTENSIONS.values()):
+        if extension != storage.extension and os.path.isfile(base_path + extension):
+            logger.debug(f"Removing old data file: {base_path + extension}")
+            os.remove(base_path + extension)
+
+    return path
+
+
+def convert_data(source_dir: str, storage: StorageFormat, exclude: list[str] = []):
+    """Convert every data file under the directory to the given format, reporting sizes and speeds."""
+    # Format -> [files, bytes, seconds]
+    read_totals: dict[str, list[float]] = {}
+    write_totals: dict[str, list[float]] = {}
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in exclude]
+        files += [os.path.join(dirpath, f) for f in filenames if data_base(f)]
+
+    with logger.progress(f"Converting to {storage}", len(files)) as progress:
+        for path in sorted(files):
+            progress.advance()
+            base_path = data_base(path)
+            source_format = StorageFormat.from_path(path)
+            if base_path is None or source_format is None:
+                continue
+
+            if source_format == StorageFormat.JSON:
+                with open(path, "rb") as f:
+                    compact = f.read(2) != b"[\n"
+                if compact:
+                    source_format = StorageFormat.COMPACT
+            if source_format == storage:
+                continue
+
+            source_size = os.path.getsize(path)
+            started = perf_counter()
+            data = list(iter_data_file(path))
+            read_time = perf_counter() - started
+
+            started = perf_counter()
+            target_path = save_data(data, base_path, storage)
+            write_time = perf_counter() - started
+            target_size = os.path.getsize(target_path)
+
+            for totals, key, size, seconds in [
+                (read_totals, source_format, source_size, read_time),
+                (write_totals, storage, target_size, write_time),
+            ]:
+                entry = totals.setdefault(key, [0, 0, 0])
+                entry[0] += 1
+                entry[1] += size
+                entry[2] += seconds
 
+            logger.debug(
+                f"{os.path.relpath(path, source_dir)}: {logger.format_bytes(source_size)}"
+                f" -> {logger.format_bytes(target_size)}"
+                f" (read {read_time:.2f}s, write {write_time:.2f}s)"
+            )
 
-def save_json_file(data: dict | list, path: str):
-    """Save data to a JSON file."""
-    with open(path, "w", encoding="utf-8") as f:
-        logger.debug(f"Writing data to: {path}")
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    for label, totals in [("Read", read_totals), ("Wrote", write_totals)]:
+        for name, (count, total_size, seconds) in totals.items():
+            speed = logger.format_bytes(total_size / max(seconds, 0.001))
+            logger.info(
+                f"{label} {int(count)} {name} files: {logger.format_bytes(total_size)}"
+                f" in {seconds:.2f}s ({speed}/s)"
+            )
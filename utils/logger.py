@@ -1,5 +1,12 @@
+from contextlib import contextmanager
 from enum import Enum
+import atexit
+import json
+import shutil
 import sys
+from threading import RLock, local
+from time import monotonic, time
+from typing import Callable, Iterator, TextIO
 
 
 # Copied from https://github.com/termcolor/termcolor
@@ -23,6 +30,12 @@ COLORS: dict[str, int] = {
     "white": 97,
 }
 
+# How often (in seconds) buffered output is flushed and the progress line redrawn
+FLUSH_INTERVAL = 0.5
+
+# Units used when formatting byte counts
+BYTE_UNITS = ["B", "KB", "MB", "GB", "TB"]
+
 
 class Level(Enum):
     """Level of the logger."""
@@ -39,8 +52,87 @@ class Level(Enum):
         return NotImplemented
 
 
+# A message, or a function that builds one (only called if the message is shown)
+Message = object | Callable[[], object]
+
+
 log_level: Level = Level.INFO
 
+_lock = RLock()
+_buffer: list[str] = []
+_last_flush = 0.0
+_progress: list["Progress"] = []
+_progress_shown = False
+_structured: TextIO | None = None
+_thread = local()
+
+
+class Capture:
+    """Messages logged by a thread that are being held back until it's their turn to be shown."""
+
+    lines: list[str]
+
+    def __init__(self):
+        self.lines = []
+        self.live = False
+
+
+class Progress:
+    """Live progress for a single phase of work (e.g. downloading one resource).
+
+    Requests count towards the phase of the thread that made them (see `inherit`), and towards
+    the phases it's part of.
+    """
+
+    def __init__(self, label: str, total: int | None = None):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.requests = 0
+        self.bytes = 0
+        self.parent: Progress | None = getattr(_thread, "progress", None)
+        self._started = monotonic()
+
+    def advance(self, count: int = 1):
+        """Mark a number of items as done."""
+        with _lock:
+            self.done += count
+        _tick()
+
+    def stats(self) -> dict:
+        """Get the current numbers for this phase."""
+        elapsed = max(monotonic() - self._started, 0.001)
+        eta = None
+        if self.total and self.done:
+            eta = max(self.total - self.done, 0) * elapsed / self.done
+
+        return {
+            "label": self.label,
+            "done": self.done,
+            "total": self.total,
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "elapsed": round(elapsed, 3),
+            "requests_per_second": round(self.requests / elapsed, 3),
+            "bytes_per_second": round(self.bytes / elapsed, 3),
+            "eta": round(eta, 3) if eta is not None else None,
+        }
+
+    def render(self, compact: bool = False) -> str:
+        """Format the progress as a single line (or just how far along it is, if compact)."""
+        stats = self.stats()
+        done = f"{stats['done']}/{stats['total']}" if stats["total"] else stats["done"]
+        if compact:
+            return f"{self.label}: {done}"
+
+        eta = format_duration(stats["eta"]) if stats["eta"] is not None else "?"
+        return (
+            f"{self.label}: {done}"
+            f" | {stats['requests_per_second']:.1f} req/s"
+            f" | {format_bytes(stats['bytes_per_second'])}/s"
+            f" | ETA {eta}"
+        )
+
 
 def _colorize(message: object, color: str) -> str:
     """Add color to a message."""
@@ -50,50 +142,250 @@ def _colorize(message: object, color: str) -> str:
     return "\033[{}m{}\033[0m".format(COLORS[color], str(message))
 
 
-def debug(message: object):
+def _resolve(message: Message) -> str:
+    """Turn a (possibly lazy) message into text."""
+    return str(message() if callable(message) else message)
+
+
+def _write_structured(record: dict):
+    """Write a record to the structured log, if there is one."""
+    if _structured is None:
+        return
+
+    _structured.write(json.dumps({"time": time()} | record, ensure_ascii=False))
+    _structured.write("\n")
+
+
+def _clear_progress():
+    """Remove the progress line from the terminal so something else can be written."""
+    global _progress_shown
+
+    if _progress_shown:
+        sys.stdout.write("\r\033[K")
+        _progress_shown = False
+
+
+def _flush():
+    """Write out everything that has been buffered, then redraw the progress line."""
+    global _last_flush, _progress_shown
+
+    _clear_progress()
+    if _buffer:
+        sys.stdout.write("".join(_buffer))
+        _buffer.clear()
+
+    if _progress and enabled(Level.INFO):
+        if len(_progress) == 1:
+            line = _progress[0].render()
+        else:
+            line = " | ".join(current.render(compact=True) for current in _progress)
+        if sys.stdout.isatty():
+            sys.stdout.write(line[: shutil.get_terminal_size().columns - 1])
+            _progress_shown = True
+        for current in _progress:
+            _write_structured({"event": "progress"} | current.stats())
+
+    sys.stdout.flush()
+    if _structured is not None:
+        _structured.flush()
+
+    _last_flush = monotonic()
+
+
+def _tick():
+    """Flush if it has been a while since the last time."""
+    with _lock:
+        if monotonic() - _last_flush >= FLUSH_INTERVAL:
+            _flush()
+
+
+def _emit(level: Level, text: str, color: str = "", to_stderr: bool = False):
+    """Buffer a message for output (errors are written straight away)."""
+    with _lock:
+        _write_structured({"level": level.name.lower(), "message": text})
+
+        output = _colorize(text, color) if color else text
+        if to_stderr:
+            _clear_progress()
+            sys.stdout.write("".join(_buffer))
+            _buffer.clear()
+            sys.stdout.flush()
+            print(output, file=sys.stderr, flush=True)
+            _flush()
+            return
+
+        current = held()
+        if current is not None and not current.live:
+            current.lines.append(output + "\n")
+            return
+
+        _buffer.append(output + "\n")
+        if monotonic() - _last_flush >= FLUSH_INTERVAL:
+            _flush()
+
+
+@contextmanager
+def capture(captured: Capture) -> Iterator[Capture]:
+    """Hold back the messages logged by this thread until `release` is called (errors still go
+    out straight away).
+    """
+    _thread.capture = captured
+    try:
+        yield captured
+    finally:
+        _thread.capture = None
+
+
+def enabled(level: Level) -> bool:
+    """Check whether messages of the given level would be shown."""
+    return not log_level < level
+
+
+def flush():
+    """Write out any buffered output."""
+    with _lock:
+        _flush()
+
+
+def format_bytes(size: float) -> str:
+    """Format a number of bytes for humans."""
+    for unit in BYTE_UNITS:
+        if abs(size) < 1024 or unit == BYTE_UNITS[-1]:
+            break
+        size /= 1024
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_duration(seconds: float) -> str:
+    """Format a number of seconds for humans."""
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h{minutes:02}m"
+    if minutes:
+        return f"{minutes}m{seconds:02}s"
+    return f"{seconds}s"
+
+
+def open_structured_log(path: str):
+    """Also write every message and progress update as JSON lines to the given file."""
+    global _structured
+
+    with _lock:
+        if _structured is not None:
+            _structured.close()
+        _structured = open(path, "a", encoding="utf-8")
+
+
+@contextmanager
+def progress(label: str, total: int | None = None) -> Iterator[Progress]:
+    """Show a live progress line while the block runs, counting this thread's requests towards it."""
+    current = Progress(label, total)
+    with _lock:
+        _flush()
+        _progress.append(current)
+    _thread.progress = current
+    try:
+        yield current
+    finally:
+        _thread.progress = current.parent
+        with _lock:
+            _flush()
+            _clear_progress()
+            _write_structured({"event": "progress_done"} | current.stats())
+            _progress.remove(current)
+            sys.stdout.flush()
+
+
+def release(captured: Capture):
+    """Write out the messages a thread has held back, and let any more through as they happen."""
+    with _lock:
+        captured.live = True
+        _buffer.extend(captured.lines)
+        captured.lines.clear()
+        _flush()
+
+
+def record_request(size: int):
+    """Count a finished request (and how many bytes it brought back) towards the throughput of
+    this thread's progress.
+    """
+    with _lock:
+        current = getattr(_thread, "progress", None)
+        while current is not None:
+            current.requests += 1
+            current.bytes += size
+            current = current.parent
+    _tick()
+
+
+def debug(message: Message):
     """Log a debug message."""
     if log_level < Level.DEBUG:
         return
 
-    print(_colorize(message, "dark_grey"))
+    _emit(Level.DEBUG, _resolve(message), "dark_grey")
 
 
-def error(message: object):
+def error(message: Message):
     """Log an error message."""
     if log_level < Level.ERROR:
         return
 
-    print(_colorize(message, "red"), file=sys.stderr)
+    _emit(Level.ERROR, _resolve(message), "red", to_stderr=True)
 
 
-def fatal(message: object):
+def fatal(message: Message):
     """Log an error message and then exit erroneously."""
     if log_level < Level.ERROR:
         return
 
-    print(_colorize(message, "red"), file=sys.stderr)
+    _emit(Level.ERROR, _resolve(message), "red", to_stderr=True)
     sys.exit(1)
 
 
-def info(message: object):
+def held() -> Capture | None:
+    """Get where this thread's messages are being held back, if they are."""
+    return getattr(_thread, "capture", None)
+
+
+def hold(captured: Capture | None, progress: Progress | None = None):
+    """Hold back this thread's messages and count its requests along with another thread's, as
+    given by `inherit` (e.g. as the initializer of a pool).
+    """
+    _thread.capture = captured
+    _thread.progress = progress
+
+
+def inherit() -> tuple[Capture | None, Progress | None]:
+    """Get what `hold` needs for another thread to be treated as part of this one."""
+    return held(), getattr(_thread, "progress", None)
+
+
+def info(message: Message):
     """Log a regular message."""
     if log_level < Level.INFO:
         return
 
-    print(message)
+    _emit(Level.INFO, _resolve(message))
 
 
-def success(message: object):
+def success(message: Message):
     """Log a success message."""
     if log_level < Level.INFO:
         return
 
-    print(_colorize(message, "green"))
+    _emit(Level.INFO, _resolve(message), "green")
 
 
-def warn(message: object):
+def warn(message: Message):
     """Log a warning message."""
     if log_level < Level.WARNING:
         return
 
-    print(_colorize(message, "yellow"))
+    _emit(Level.WARNING, _resolve(message), "yellow")
+
+
+atexit.register(flush)
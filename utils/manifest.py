@@ -0,0 +1,104 @@
+import json
+import os
+from threading import Lock
+
+from utils import logger
+
+
+# Name of the manifest in the target directory (not .json so it's never taken for data)
+MANIFEST_FILE = "manifest.jsonl"
+
+# Rewrite the manifest when it has this many times more lines than entries
+COMPACT_RATIO = 4
+
+
+class Manifest:
+    """What's known about each file in the mirror, keyed by its path relative to the mirror.
+
+    Changes are appended to the file as JSON lines as they happen, so nothing is lost if a
+    run is interrupted, and replayed (last one wins) when it's loaded.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.path = os.path.join(root_dir, MANIFEST_FILE)
+        self.entries: dict[str, dict] = {}
+        self._lines = 0
+        self._lock = Lock()
+        self._load()
+        os.makedirs(root_dir, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def __enter__(self) -> "Manifest":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _append(self, record: dict):
+        """Write a change to the end of the manifest."""
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()  # so a crash doesn't lose what's still buffered
+        self._lines += 1
+
+    def _load(self):
+        """Replay the manifest from disk."""
+        if not os.path.isfile(self.path):
+            return
+
+        logger.debug(f"Loading manifest: {self.path}")
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # most likely cut off at the end of an interrupted run
+
+                self._lines += 1
+                path = record.pop("path", None)
+                if path is None:
+                    continue
+                if record.get("removed"):
+                    self.entries.pop(path, None)
+                else:
+                    self.entries.setdefault(path, {}).update(record)
+
+    def close(self):
+        """Write out everything, compacting the manifest if it's mostly old changes."""
+        with self._lock:
+            self._file.close()
+            if self._lines > max(len(self.entries), 1) * COMPACT_RATIO:
+                self.compact()
+
+    def compact(self):
+        """Rewrite the manifest with only the current entries."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for path, entry in sorted(self.entries.items()):
+                f.write(json.dumps({"path": path} | entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+        self._lines = len(self.entries)
+
+    def get(self, path: str) -> dict | None:
+        """Get the entry for a file."""
+        return self.entries.get(self.relative(path))
+
+    def relative(self, path: str) -> str:
+        """Get the key used for a file (its path relative to the mirror, with forward slashes)."""
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root_dir)
+        return path.replace(os.sep, "/")
+
+    def remove(self, path: str):
+        """Forget about a file."""
+        key = self.relative(path)
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._append({"path": key, "removed": True})
+
+    def update(self, path: str, **fields):
+        """Record new details about a file."""
+        key = self.relative(path)
+        with self._lock:
+            self.entries.setdefault(key, {}).update(fields)
+            self._append({"path": key} | fields)
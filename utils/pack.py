@@ -0,0 +1,232 @@
+import json
+import mmap
+import os
+import struct
+from threading import Lock
+from typing import Iterator
+
+from utils import file, logger
+
+
+# How many galleries go into each pack (matches the thousand-ID folders)
+BLOCK_SIZE = 1000
+
+# Extension of the file holding the gallery data
+PACK_EXTENSION = ".pack"
+
+# Extension of the file holding where each gallery is in the pack
+INDEX_EXTENSION = ".idx"
+
+# Each index record is the gallery ID, offset into the pack, and length of the data
+INDEX_RECORD = struct.Struct("<IQI")
+
+# Extension of the new pack and index while a pack is being compacted
+COMPACT_EXTENSION = ".tmp"
+
+# Whether new image data is written to packs rather than one file per gallery
+enabled: bool = False
+
+
+class Pack:
+    """An append-only file holding the galleries for one block of IDs, plus an index of offsets.
+
+    Galleries are stored as compact JSON one after another. Writing a gallery that has changed
+    appends a new copy, and the index entry written last wins (an empty entry removes the
+    gallery). Old copies stay in the pack until it's compacted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path[: -len(PACK_EXTENSION)] + INDEX_EXTENSION
+        self.index: dict[int, tuple[int, int]] = {}
+        self._lock = Lock()
+        self._finish_compact()
+        self._load_index()
+
+    def __contains__(self, gallery_id: object) -> bool:
+        return gallery_id in self.index
+
+    def __iter__(self) -> Iterator[tuple[int, list]]:
+        """Go through every gallery in the pack, reading from a single memory map."""
+        if not self.index:
+            return
+
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for gallery_id, (offset, length) in sorted(self.index.items()):
+                    yield gallery_id, json.loads(data[offset : offset + length])
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _finish_compact(self):
+        """Clean up after a compaction that was interrupted.
+
+        Both new files are written before either is moved into place, so if only the new
+        index is left the pack was already moved and the index has to follow it.
+        """
+        new_path = self.path + COMPACT_EXTENSION
+        new_index_path = self.index_path + COMPACT_EXTENSION
+        if os.path.isfile(new_path):
+            os.remove(new_path)
+            if os.path.isfile(new_index_path):
+                os.remove(new_index_path)
+        elif os.path.isfile(new_index_path):
+            os.replace(new_index_path, self.index_path)
+
+    def _load_index(self):
+        """Read the index, ignoring anything pointing past the end of the pack."""
+        if not os.path.isfile(self.index_path) or not os.path.isfile(self.path):
+            return
+
+        pack_size = os.path.getsize(self.path)
+        with open(self.index_path, "rb") as f:
+            records = f.read()
+
+        usable = len(records) - len(records) % INDEX_RECORD.size
+        for gallery_id, offset, length in INDEX_RECORD.iter_unpack(records[:usable]):
+            if length == 0:
+                self.index.pop(gallery_id, None)
+            elif offset + length <= pack_size:
+                self.index[gallery_id] = (offset, length)
+
+    def append(self, gallery_id: int, data: list) -> bool:
+        """Add a gallery to the end of the pack, returning False if it's there already unchanged."""
+        if gallery_id in self.index and self.read(gallery_id) == data:
+            return False
+
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(encoded)
+            # Only point at the data once it's been written
+            with open(self.index_path, "ab") as f:
+                f.write(INDEX_RECORD.pack(gallery_id, offset, len(encoded)))
+            self.index[gallery_id] = (offset, len(encoded))
+
+        return True
+
+    def compact(self) -> int:
+        """Rewrite the pack with only the current copy of each gallery, returning how many
+        bytes that freed.
+        """
+        with self._lock:
+            if not os.path.isfile(self.path):
+                return 0
+
+            size = os.path.getsize(self.path)
+            if sum(length for _, length in self.index.values()) == size:
+                return 0
+
+            new_path = self.path + COMPACT_EXTENSION
+            new_index_path = self.index_path + COMPACT_EXTENSION
+            index = {}
+            with open(self.path, "rb") as f, open(new_path, "wb") as out:
+                for gallery_id, (offset, length) in sorted(self.index.items()):
+                    f.seek(offset)
+                    index[gallery_id] = (out.tell(), length)
+                    out.write(f.read(length))
+                out.flush()
+                os.fsync(out.fileno())
+            with open(new_index_path, "wb") as out:
+                for gallery_id, (offset, length) in index.items():
+                    out.write(INDEX_RECORD.pack(gallery_id, offset, length))
+                out.flush()
+                os.fsync(out.fileno())
+
+            os.replace(new_path, self.path)
+            os.replace(new_index_path, self.index_path)
+            self.index = index
+
+            return size - os.path.getsize(self.path)
+
+    def discard(self, gallery_id: int):
+        """Forget about a gallery (e.g. because it's corrupt) so it gets downloaded again."""
+        with self._lock:
+            with open(self.index_path, "ab") as f:
+                f.write(INDEX_RECORD.pack(gallery_id, 0, 0))
+            self.index.pop(gallery_id, None)
+
+    def read(self, gallery_id: int) -> list:
+        """Read a single gallery from the pack."""
+        offset, length = self.index[gallery_id]
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return json.loads(data[offset : offset + length])
+
+
+_packs: dict[str, Pack] = {}
+_packs_lock = Lock()
+
+
+def block_for(gallery_id: int) -> int:
+    """Get which block of IDs a gallery belongs to."""
+    return gallery_id // BLOCK_SIZE
+
+
+def list_packs(resource_dir: str) -> list[str]:
+    """Get all the packs in a directory, in order."""
+    if not os.path.isdir(resource_dir):
+        return []
+
+    packs = [f for f in os.listdir(resource_dir) if f.endswith(PACK_EXTENSION)]
+    return [
+        os.path.join(resource_dir, f)
+        for f in sorted(packs, key=lambda f: int(f[: -len(PACK_EXTENSION)]))
+    ]
+
+
+def migrate(resource_dir: str) -> int:
+    """Move the galleries from the thousand-ID folders into packs and compact every pack,
+    returning how many galleries moved.
+    """
+    blocks = sorted(
+        (int(d), os.path.join(resource_dir, d))
+        for d in os.listdir(resource_dir)
+        if d.isdigit() and os.path.isdir(os.path.join(resource_dir, d))
+    )
+
+    moved = 0
+    with logger.progress("Packing", len(blocks)) as progress:
+        for block, block_dir in blocks:
+            progress.advance()
+            files = []
+            for filename in os.listdir(block_dir):
+                base_name = file.data_base(filename)
+                if base_name is not None and base_name.isdigit():
+                    files.append((int(base_name), os.path.join(block_dir, filename)))
+
+            current = open_pack(resource_dir, block * BLOCK_SIZE)
+            packed_at = os.path.getmtime(current.path) if len(current) else 0
+            for gallery_id, path in sorted(files):
+                # Keep whichever copy is newest if the gallery is already packed
+                if gallery_id not in current or os.path.getmtime(path) > packed_at:
+                    current.append(gallery_id, list(file.iter_data_file(path)))
+                os.remove(path)
+                moved += 1
+
+            logger.debug(f"Packed {len(files)} galleries into {current.path}")
+            if not os.listdir(block_dir):
+                os.rmdir(block_dir)
+
+    freed = 0
+    packs = list_packs(resource_dir)
+    with logger.progress("Compacting", len(packs)) as progress:
+        for pack_path in packs:
+            progress.advance()
+            block = int(os.path.basename(pack_path)[: -len(PACK_EXTENSION)])
+            freed += open_pack(resource_dir, block * BLOCK_SIZE).compact()
+
+    logger.info(f"Freed {logger.format_bytes(freed)} of old copies from packs")
+
+    return moved
+
+
+def open_pack(resource_dir: str, gallery_id: int) -> Pack:
+    """Get the pack a gallery belongs in (reusing it if it's already been opened)."""
+    path = os.path.join(resource_dir, f"{block_for(gallery_id)}{PACK_EXTENSION}")
+    with _packs_lock:
+        if path not in _packs:
+            _packs[path] = Pack(path)
+        return _packs[path]
@@ -0,0 +1,218 @@
+import math
+import os
+
+from utils import api, file, logger, pack
+from utils.manifest import Manifest
+from utils.resource import Resource, find_galleries
+
+
+# How long a request is assumed to take when nothing could be probed
+DEFAULT_LATENCY = 1.0
+
+# How many galleries of image data are checked (see Resource.download_data)
+IMAGE_DATA_GALLERIES = 1999999
+
+# How many reviews are fetched one at a time (see Resource.download_data)
+REVIEW_COUNT = 1000
+
+
+class Estimate:
+    """What downloading a resource is expected to cost (None meaning it can't be known up front)."""
+
+    def __init__(
+        self,
+        resource: Resource,
+        requests: int | None = 0,
+        size: float | None = None,
+        seconds: float | None = 0,
+        note: str = "",
+        split: bool = False,
+    ):
+        self.resource = resource
+        self.requests = requests
+        self.size = size
+        self.seconds = seconds
+        self.note = note
+        self.split = split
+
+
+def _request_time(latency: float, workers: int = 1) -> float:
+    """How long each request takes on average, given the rate limit."""
+    return max(api.REQUEST_DELAY, latency / workers)
+
+
+def _estimate_images(
+    target_dir: str, skip_existing: bool, workers: int, latency: float
+) -> Estimate:
+    """Estimate the galleries referenced by the data that's already been downloaded."""
+    resource_dir = os.path.join(target_dir, Resource.IMAGES.value)
+    requests = 0
+    for resource_id, total in find_galleries(target_dir).items():
+        resource_file = os.path.join(resource_dir, resource_id)
+        if skip_existing and file.find_data_file(resource_file):
+            continue
+        requests += max(math.ceil(total / api.PAGE_REQUEST_LIMIT), 1)
+
+    return Estimate(
+        Resource.IMAGES,
+        requests,
+        seconds=requests * _request_time(latency, workers),
+        note="from the data already downloaded",
+        split=workers > 1,
+    )
+
+
+def _estimate_image_data(
+    target_dir: str, skip_existing: bool, latency: float
+) -> Estimate:
+    """Estimate the gallery data, which isn't rate limited but goes one gallery at a time."""
+    galleries = IMAGE_DATA_GALLERIES
+    if skip_existing:
+        resource_dir = os.path.join(target_dir, Resource.IMAGE_DATA.value)
+        for pack_path in pack.list_packs(resource_dir):
+            galleries -= len(pack.Pack(pack_path))
+        galleries -= len(file.list_data_files(resource_dir))
+
+    return Estimate(
+        Resource.IMAGE_DATA,
+        galleries,
+        seconds=galleries * latency,
+        note="at least one request per gallery",
+    )
+
+
+def _estimate_paged(
+    resource: Resource,
+    api_key: str,
+    workers: int,
+    manifest: Manifest | None,
+) -> tuple[Estimate, float]:
+    """Probe the first page of a resource and estimate the rest from it, also returning how long
+    the probe took.
+    """
+    total, page_size, _, latency = api.probe_paged_resource(
+        resource.value, api_key, resource.field_list()
+    )
+    pages = max(math.ceil((total or 0) / api.PAGE_REQUEST_LIMIT), 1)
+    size: float = page_size * pages
+
+    # The last download is a better guide to the size if it fetched the same fields
+    entry = manifest.get(resource.value) if manifest else None
+    if entry and entry.get("fields") == resource.field_list() and entry.get("items"):
+        size = entry["bytes"] / entry["items"] * (total or 0)
+
+    split = workers > 1 and pages - 1 >= api.SPLIT_MIN_PAGES
+    seconds = _request_time(latency) + (pages - 1) * _request_time(
+        latency, workers if split else 1
+    )
+    note = "" if total is not None else "total unknown, only one page counted"
+
+    return Estimate(resource, pages, size, seconds, note, split), latency
+
+
+def estimate(
+    resources: list[Resource],
+    target_dir: str,
+    api_key: str,
+    skip_existing: bool,
+    workers: int,
+    manifest: Manifest | None = None,
+) -> list[Estimate]:
+    """Estimate how many requests, bytes and seconds each resource will take to download.
+
+    Paged resources have their first page fetched to find out how long they are. Everything
+    else is worked out from what's already in the mirror (which is why images come last).
+    """
+    estimates: dict[Resource, Estimate] = {}
+    latencies: list[float] = []
+
+    with logger.progress("Planning", len(resources)) as progress:
+        for resource in sorted(resources, key=lambda r: r == Resource.IMAGES):
+            progress.advance()
+            if (
+                skip_existing
+                and resource not in [Resource.IMAGE_DATA, Resource.IMAGES]
+                and resource.is_downloaded(target_dir, manifest)
+            ):
+                estimates[resource] = Estimate(resource, note="skipped, already exists")
+                continue
+
+            latency = sum(latencies) / len(latencies) if latencies else DEFAULT_LATENCY
+            if resource.paged:
+                try:
+                    estimates[resource], probed = _estimate_paged(
+                        resource, api_key, workers, manifest
+                    )
+                    latencies.append(probed)
+                except api.ApiError as error:
+                    estimates[resource] = Estimate(
+                        resource, None, seconds=None, note=f"probe failed: {error}"
+                    )
+            elif resource == Resource.ARTICLES:
+                estimates[resource] = Estimate(
+                    resource, None, seconds=None, note="scraped until the pages run out"
+                )
+            elif resource == Resource.IMAGE_DATA:
+                estimates[resource] = _estimate_image_data(
+                    target_dir, skip_existing, latency
+                )
+            elif resource == Resource.IMAGES:
+                estimates[resource] = _estimate_images(
+                    target_dir, skip_existing, workers, latency
+                )
+            elif resource == Resource.REVIEWS:
+                estimates[resource] = Estimate(
+                    resource,
+                    REVIEW_COUNT,
+                    seconds=REVIEW_COUNT * _request_time(latency),
+                )
+            elif resource == Resource.TYPES:
+                estimates[resource] = Estimate(
+                    resource, 1, seconds=_request_time(latency)
+                )
+
+    return [estimates[resource] for resource in resources if resource in estimates]
+
+
+def log_plan(estimates: list[Estimate]):
+    """Show the estimates as a table, with totals at the bottom."""
+    width = max([len(e.resource.value) for e in estimates] + [8])
+    logger.info(
+        f"{'Resource':<{width}}  {'Requests':>9}  {'Size':>9}  {'Time':>8}  Split"
+    )
+
+    requests = 0
+    size = 0.0
+    seconds = 0.0
+    for e in estimates:
+        requests += e.requests or 0
+        size += e.size or 0
+        seconds += e.seconds or 0
+        line = (
+            f"{e.resource.value:<{width}}"
+            f"  {'?' if e.requests is None else e.requests:>9}"
+            f"  {'?' if e.size is None else logger.format_bytes(e.size):>9}"
+            f"  {'?' if e.seconds is None else logger.format_duration(e.seconds):>8}"
+            f"  {'yes' if e.split else 'no':<5}"
+        )
+        logger.info(f"{line}  {e.note}".rstrip())
+
+    logger.success(
+        f"{'Total':<{width}}  {requests:>9}  {logger.format_bytes(size):>9}"
+        f"  {logger.format_duration(seconds):>8}"
+    )
+
+
+def order_by_cost(estimates: list[Estimate]) -> list[Resource]:
+    """Order resources so the cheapest finish first, with unknowns and images at the end."""
+    return [
+        e.resource
+        for e in sorted(
+            estimates,
+            key=lambda e: (
+                e.resource == Resource.IMAGES,
+                e.seconds is None,
+                e.seconds or 0,
+            ),
+        )
+    ]
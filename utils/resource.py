@@ -1,12 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import StrEnum
 import math
 import re
 import os
+from time import perf_counter, time
 from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
 
-from utils import api, file, logger
+from utils import api, database, file, logger, pack
+from utils.manifest import Manifest
 
 
 # Which image size to download
@@ -24,6 +27,40 @@ IMAGE_SOURCE_ATTRIBUTES = [
 
 SRCSET_WIDTH_RE = r"\s+\d+w$"
 
+# Resources fetched through the API a page at a time
+PAGED_RESOURCES = [
+    "accessories",
+    "characters",
+    "chats",
+    "companies",
+    "concepts",
+    "dlcs",
+    "franchises",
+    "games",
+    "game_ratings",
+    "genres",
+    "locations",
+    "objects",
+    "people",
+    "platforms",
+    "promos",
+    "rating_boards",
+    "regions",
+    "releases",
+    "user_reviews",
+    "themes",
+    "video_categories",
+    "video_shows",
+    "video_types",
+    "videos",
+]
+
+# Extra fields the index profile needs for some resources (the ones their images are in)
+INDEX_EXTRA_FIELDS: dict[str, list[str]] = {
+    "video_shows": ["logo"],
+    "videos": ["video_show"],
+}
+
 
 def _extract_images_from_field(items: list[dict], field: str) -> list[str]:
     """Extract out the image field from a list of items."""
@@ -151,13 +188,62 @@ def _extract_article_contents_from_page(page: str) -> dict:
     }
 
 
-def _save_data(data: list, target_file: str):
-    """Save the data to a given file, logging how much."""
-    file.save_json_file(data, target_file)
-    if len(data) == 0:
+def _estimate_saved(entry: dict | None, items: int, downloaded: int) -> int | None:
+    """Estimate how many bytes fetching fewer fields saved, going by the resource's last full
+    download (None if there hasn't been one).
+    """
+    if not entry or not entry.get("full_items"):
+        return None
+    return max(round(entry["full_bytes"] / entry["full_items"] * items) - downloaded, 0)
+
+
+def _has_fields(fields: list[str] | None, wanted: list[str] | None) -> bool:
+    """Check whether data with the given fields (None meaning all of them) has the ones wanted."""
+    return fields is None or (wanted is not None and set(wanted) <= set(fields))
+
+
+def _save_data(
+    data: list, target_base: str, table: str, source: str = "", summary: bool = True
+):
+    """Save the data in the current storage format (and the database, if there is one), logging how much.
+
+    Saves that aren't a summary of a whole resource are only logged as debug output.
+    """
+    started = perf_counter()
+    target_file = file.save_data(data, target_base)
+    database.save_items(table, data, source)
+    elapsed = perf_counter() - started
+    size = logger.format_bytes(os.path.getsize(target_file))
+
+    if not summary:
+        logger.debug(f" -> saved {len(data)} items to {target_file} ({size})")
+    elif len(data) == 0:
         logger.warn(" -> saved 0 items")
     else:
-        logger.success(f" -> saved {len(data)} items")
+        logger.success(
+            f" -> saved {len(data)} items ({size} of {file.storage_format} in {elapsed:.2f}s)"
+        )
+
+
+def find_galleries(target_dir: str) -> dict[str, int]:
+    """Find the galleries referenced by the image tags of every resource, with how many images each has."""
+    galleries: dict[str, int] = {}
+    filenames = next(os.walk(target_dir), (None, None, []))[2]
+    for filename in filenames:
+        source_file = os.path.join(target_dir, filename)
+        if file.data_base(source_file) is None:
+            continue
+
+        for item in file.iter_data_file(source_file):
+            if isinstance(item, dict) and "image_tags" in item:
+                for tag in item["image_tags"]:
+                    url = urlparse(tag["api_detail_url"])
+                    gallery_id = url.path.rsplit("/")[-2]
+                    galleries[gallery_id] = max(
+                        galleries.get(gallery_id, 0), tag.get("total") or 0
+                    )
+
+    return galleries
 
 
 class Resource(StrEnum):
@@ -193,8 +279,19 @@ class Resource(StrEnum):
     VIDEO_TYPES = "video_types"
     VIDEOS = "videos"
 
-    def download_data(self, target_dir: str, api_key: str, skip_existing: bool):
-        """Download data for this resource, saving it in the given directory."""
+    def download_data(
+        self,
+        target_dir: str,
+        api_key: str,
+        skip_existing: bool,
+        workers: int = 1,
+        manifest: Manifest | None = None,
+    ):
+        """Download data for this resource, saving it in the given directory.
+
+        If there's a manifest, the fields that were fetched and how many bytes it took are
+        recorded in it.
+        """
         if not os.path.isdir(target_dir):
             logger.debug(f"Creating directory: {target_dir}")
             os.makedirs(target_dir)
@@ -202,8 +299,8 @@ class Resource(StrEnum):
         # Special resource handling
 
         if self == Resource.ARTICLES:
-            resource_file = os.path.join(target_dir, f"{self.value}.json")
-            if os.path.isfile(resource_file) and skip_existing:
+            resource_file = os.path.join(target_dir, self.value)
+            if file.find_data_file(resource_file) and skip_existing:
                 logger.info(f"Skipping existing resource: {self.value}")
                 return
 
@@ -213,137 +310,235 @@ class Resource(StrEnum):
             params = {
                 "type": "articles",
             }
-            while True:
-                params["page"] = str(page)
-                response = api.get_page("https://www.giantbomb.com/words/", params)
-                articles = _extract_articles_from_page(response)
-
-                if len(articles) == 0:
-                    break
-
-                for article in articles:
-                    try:
-                        response = api.get_page(article["site_detail_url"])
-                        content = _extract_article_contents_from_page(response)
-                        data.append(article | content)
-                    except api.ApiError as error:
-                        logger.error(
-                            f"Unable to extract article content from {article['site_detail_url']}: {error}"
-                        )
-                        data.append(article)
+            with logger.progress(self.value) as progress:
+                while True:
+                    params["page"] = str(page)
+                    response = api.get_page("https://www.giantbomb.com/words/", params)
+                    articles = _extract_articles_from_page(response)
 
-                page += 1
+                    if len(articles) == 0:
+                        break
 
-            _save_data(data, resource_file)
+                    for article in articles:
+                        try:
+                            response = api.get_page(article["site_detail_url"])
+                            content = _extract_article_contents_from_page(response)
+                            data.append(article | content)
+                        except api.ApiError as error:
+                            logger.error(
+                                f"Unable to extract article content from {article['site_detail_url']}: {error}"
+                            )
+                            data.append(article)
+                        progress.advance()
+
+                    page += 1
+
+            _save_data(data, resource_file, self.value)
 
             return
 
         if self == Resource.IMAGE_DATA:
-            # Split resources into files, organised into folder by thousands
+            # Split resources into files (or packs), organised by thousands
             resource_dir = os.path.join(target_dir, self.value)
-            for gallery_id in range(1, 2000000):
-                gallery_dir = os.path.join(
-                    resource_dir, str(math.floor(gallery_id / 1000))
-                )
-                resource_file = os.path.join(gallery_dir, f"{gallery_id}.json")
-                if os.path.isfile(resource_file) and skip_existing:
-                    logger.info(
-                        f"Skipping existing resource: {self.value}/{gallery_id}"
+            if not os.path.isdir(resource_dir):
+                logger.debug(f"Creating directory: {resource_dir}")
+                os.makedirs(resource_dir)
+
+            logger.info(f"Downloading {self.value}...")
+            with logger.progress(self.value, 1999999) as progress:
+                for gallery_id in range(1, 2000000):
+                    progress.advance()
+                    gallery_dir = os.path.join(
+                        resource_dir, str(math.floor(gallery_id / 1000))
                     )
-                    continue
+                    gallery_pack = pack.open_pack(resource_dir, gallery_id)
+                    resource_file = os.path.join(gallery_dir, str(gallery_id))
+                    if skip_existing and (
+                        gallery_id in gallery_pack or file.find_data_file(resource_file)
+                    ):
+                        logger.debug(
+                            f"Skipping existing resource: {self.value}/{gallery_id}"
+                        )
+                        continue
+
+                    logger.debug(f"Downloading {self.value}/{gallery_id}...")
+                    data = api.get_image_data(f"1310-{gallery_id}")
+
+                    if pack.enabled:
+                        if not gallery_pack.append(gallery_id, data):
+                            logger.debug(f" -> unchanged in {gallery_pack.path}")
+                            continue
+                        database.save_items(self.value, data, str(gallery_id))
+                        logger.debug(
+                            f" -> saved {len(data)} items to {gallery_pack.path}"
+                        )
+                        continue
 
-                if not os.path.isdir(gallery_dir):
-                    logger.debug(f"Creating directory: {gallery_dir}")
-                    os.makedirs(gallery_dir)
+                    if not os.path.isdir(gallery_dir):
+                        logger.debug(f"Creating directory: {gallery_dir}")
+                        os.makedirs(gallery_dir)
 
-                logger.info(f"Downloading {self.value}/{gallery_id}...")
-                data = api.get_image_data(f"1310-{gallery_id}")
-                _save_data(data, resource_file)
+                    _save_data(
+                        data, resource_file, self.value, str(gallery_id), summary=False
+                    )
 
             return
 
         if self == Resource.IMAGES:
             logger.info(f"Extracting image resources from: {target_dir}")
-            image_resources = set()
-            filenames = next(os.walk(target_dir), (None, None, []))[2]
-            for filename in filenames:
-                source_file = os.path.join(target_dir, filename)
-                _, ext = os.path.splitext(source_file)
-                if ext != ".json":
-                    continue
-
-                data = file.load_json_file(source_file)
-                if isinstance(data, list):
-                    for item in data:
-                        if "image_tags" in item:
-                            for tag in item["image_tags"]:
-                                url = urlparse(tag["api_detail_url"])
-                                image_resources.add(url.path.rsplit("/")[-2])
+            image_resources = find_galleries(target_dir)
 
             resource_dir = os.path.join(target_dir, self.value)
             if not os.path.isdir(resource_dir):
                 logger.debug(f"Creating directory: {resource_dir}")
                 os.makedirs(resource_dir)
 
-            for resource_id in image_resources:
-                resource_file = os.path.join(resource_dir, f"{resource_id}.json")
-                resource_uri = f"images/{resource_id}"
-
-                if os.path.isfile(resource_file) and skip_existing:
-                    logger.info(f"Skipping existing resource: {resource_uri}")
+            # Biggest galleries go first so no worker is left with a huge one at the end
+            pending = []
+            for resource_id, _ in sorted(
+                image_resources.items(), key=lambda item: item[1], reverse=True
+            ):
+                resource_file = os.path.join(resource_dir, resource_id)
+                if file.find_data_file(resource_file) and skip_existing:
+                    logger.debug(f"Skipping existing resource: images/{resource_id}")
                     continue
 
-                logger.info(f"Downloading {resource_uri}...")
-                data = api.get_paged_resource(resource_uri, api_key)
-                _save_data(data, resource_file)
+                pending.append(resource_id)
+
+            logger.info(
+                f"Downloading {len(pending)} galleries using {workers} workers..."
+            )
+            with logger.progress(self.value, len(pending)) as progress:
+                executor = ThreadPoolExecutor(
+                    max_workers=workers,
+                    initializer=logger.hold,
+                    initargs=logger.inherit(),
+                )
+                futures = {
+                    executor.submit(
+                        api.get_paged_resource, f"images/{resource_id}", api_key
+                    ): resource_id
+                    for resource_id in pending
+                }
+                try:
+                    for future in as_completed(futures):
+                        # Forget about it once it's saved so the data doesn't pile up
+                        resource_id = futures.pop(future)
+                        progress.advance()
+                        try:
+                            data = future.result()
+                        except Exception as error:
+                            logger.error(
+                                f"Unable to download images/{resource_id}: {error}"
+                            )
+                            continue
+
+                        logger.debug(f"Downloaded images/{resource_id}")
+                        _save_data(
+                            data,
+                            os.path.join(resource_dir, resource_id),
+                            self.value,
+                            resource_id,
+                            summary=False,
+                        )
+                finally:
+                    # Don't go on fetching galleries that won't be saved
+                    executor.shutdown(wait=False, cancel_futures=True)
 
             return
 
         # Regular resource handling
 
-        resource_file = os.path.join(target_dir, f"{self.value}.json")
+        resource_file = os.path.join(target_dir, self.value)
         data = []
+        field_list = self.field_list() if self.paged else None
 
-        if os.path.isfile(resource_file) and skip_existing:
-            logger.info(f"Skipping existing resource: {self.value}")
-            return
+        if file.find_data_file(resource_file):
+            if skip_existing and self.is_downloaded(target_dir, manifest):
+                logger.info(f"Skipping existing resource: {self.value}")
+                return
+
+            # Never throw away fields that have been downloaded already
+            if not _has_fields(field_list, self.stored_fields(manifest)):
+                logger.warn(
+                    f"Not replacing {self.value} with the fewer fields of the {api.fetch_profile}"
+                    " profile (download it to a different directory instead)"
+                )
+                return
+
+            if skip_existing:
+                logger.info(f"Existing {self.value} is missing fields")
 
         logger.info(f"Downloading {self.value}...")
-        if self in [
-            Resource.ACCESSORIES,
-            Resource.CHARACTERS,
-            Resource.CHATS,
-            Resource.COMPANIES,
-            Resource.CONCEPTS,
-            Resource.DLCS,
-            Resource.FRANCHISES,
-            Resource.GAMES,
-            Resource.GAME_RATINGS,
-            Resource.GENRES,
-            Resource.LOCATIONS,
-            Resource.OBJECTS,
-            Resource.PEOPLE,
-            Resource.PLATFORMS,
-            Resource.PROMOS,
-            Resource.RATING_BOARDS,
-            Resource.REGIONS,
-            Resource.RELEASES,
-            Resource.USER_REVIEWS,
-            Resource.THEMES,
-            Resource.VIDEO_CATEGORIES,
-            Resource.VIDEO_SHOWS,
-            Resource.VIDEO_TYPES,
-            Resource.VIDEOS,
-        ]:
-            data = api.get_paged_resource(self.value, api_key)
+        if self.paged:
+            stats: dict = {}
+            with logger.progress(self.value) as progress:
+                data = api.get_paged_resource(
+                    self.value, api_key, progress, field_list, stats, workers
+                )
+
+            if field_list:
+                stats["bytes_saved"] = _estimate_saved(
+                    manifest.get(self.value) if manifest else None,
+                    len(data),
+                    stats["bytes"],
+                )
+                message = f" -> {api.fetch_profile} profile downloaded {logger.format_bytes(stats['bytes'])}"
+                if stats["bytes_saved"] is None:
+                    logger.info(
+                        f"{message}, saving an unknown amount (no full download to compare with)"
+                    )
+                else:
+                    saved = stats["bytes_saved"]
+                    percent = saved / max(stats["bytes"] + saved, 1) * 100
+                    logger.info(
+                        f"{message}, saving about {logger.format_bytes(saved)} ({percent:.0f}%)"
+                    )
+            else:
+                # Kept through later profile downloads, to tell how much they save
+                stats["full_bytes"] = stats["bytes"]
+                stats["full_items"] = len(data)
+            if manifest:
+                manifest.update(
+                    self.value,
+                    profile=api.fetch_profile.value,
+                    fields=field_list,
+                    items=len(data),
+                    downloaded_at=time(),
+                    **stats,
+                )
         elif self == Resource.REVIEWS:
-            data = api.get_individualized_resource("review", 1000, api_key)
+            with logger.progress(self.value, 1000) as progress:
+                data = api.get_individualized_resource(
+                    "review", 1000, api_key, progress
+                )
         elif self == Resource.TYPES:
             data = api.get_resource(self.value, api_key)
         else:
             logger.error(f"Unable to download data from resource: {self}")
 
-        _save_data(data, resource_file)
+        _save_data(data, resource_file, self.value)
+
+    def download_images(
+        self,
+        target_dir: str,
+        image_dir: str,
+        overwrite_existing: bool,
+        manifest: Manifest | None = None,
+    ):
+        """Download the image files for this resource (which has to be downloaded already)."""
+        images = self.extract_images(target_dir)
+        if len(images) == 0:
+            logger.warn(f"Got 0 images for {self}")
+            return
+
+        logger.info(f"Downloading {len(images)} images...")
+        downloaded, skipped, errors = api.download_images(
+            images, image_dir, overwrite_existing, manifest
+        )
+        logger.success(
+            f"Saved {downloaded} images ({skipped} skipped, {errors} errors)"
+        )
 
     def extract_images(self, target_dir: str) -> list[str]:
         """Extract out all the images from the given resource by loading its file."""
@@ -354,9 +549,9 @@ class Resource(StrEnum):
         if self == Resource.IMAGES:
             resource_dir = os.path.join(target_dir, self.value)
             logger.debug(f"Getting images from directory: {resource_dir}")
-            files = file.list_files(resource_dir, "json")
+            files = file.list_data_files(resource_dir)
             for file_path in files:
-                for item in file.load_json_file(file_path):
+                for item in file.iter_data_file(file_path):
                     images.append(item[IMAGE_SIZE])
 
             return list(set(images))
@@ -364,17 +559,21 @@ class Resource(StrEnum):
         if self == Resource.IMAGE_DATA:
             resource_dir = os.path.join(target_dir, self.value)
             logger.debug(f"Getting images from directory: {resource_dir}")
-            files = file.list_files(resource_dir, "json")
+            for pack_path in pack.list_packs(resource_dir):
+                for _, items in pack.Pack(pack_path):
+                    for item in items:
+                        images.append(item["original"])
+
+            files = file.list_data_files(resource_dir)
             for file_path in files:
-                for item in file.load_json_file(file_path):
+                for item in file.iter_data_file(file_path):
                     images.append(item["original"])
 
             return list(set(images))
 
         # Regular resource handling
 
-        resource_file = os.path.join(target_dir, f"{self.value}.json")
-        data = file.load_json_file(resource_file)
+        data = file.load_data(os.path.join(target_dir, self.value))
 
         if self == Resource.ACCESSORIES:
             images = _extract_images_from_field(data, "image")
@@ -450,3 +649,33 @@ class Resource(StrEnum):
             logger.error(f"Unable to extract images for resource: {self}")
 
         return list(set(images))  # remove duplicates
+
+    def field_list(self) -> list[str] | None:
+        """Get the fields to request for this resource (None meaning all of them)."""
+        if api.fetch_profile == api.FetchProfile.INDEX:
+            return api.INDEX_FIELDS + INDEX_EXTRA_FIELDS.get(self.value, [])
+        if api.fetch_profile == api.FetchProfile.CUSTOM:
+            return api.custom_fields
+
+        return None
+
+    def is_downloaded(self, target_dir: str, manifest: Manifest | None = None) -> bool:
+        """Check whether this resource has been downloaded with the fields the current profile wants."""
+        if not file.find_data_file(os.path.join(target_dir, self.value)):
+            return False
+
+        return _has_fields(
+            self.stored_fields(manifest), self.field_list() if self.paged else None
+        )
+
+    def stored_fields(self, manifest: Manifest | None) -> list[str] | None:
+        """Get the fields the downloaded data has (None meaning all of them, which is assumed
+        if the manifest doesn't say).
+        """
+        entry = manifest.get(self.value) if manifest else None
+        return entry.get("fields") if entry else None
+
+    @property
+    def paged(self) -> bool:
+        """Whether this resource is fetched through the API a page at a time."""
+        return self.value in PAGED_RESOURCES
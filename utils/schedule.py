@@ -0,0 +1,108 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from time import monotonic
+from typing import Callable
+
+from utils import logger
+
+
+class Job:
+    """A piece of work that can only start once the jobs it comes after are done."""
+
+    def __init__(self, name: str, run: Callable[[], object], after: list[str] = []):
+        self.name = name
+        self.run = run
+        self.after = after
+
+
+class _InlineExecutor(Executor):
+    """Runs everything as soon as it's submitted, in the calling thread."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:  # but let Ctrl-C through
+            future.set_exception(error)
+        return future
+
+
+def _run(job: Job, held: logger.Capture):
+    """Run a job, holding back its output until it's the job's turn to be shown."""
+    started = monotonic()
+    with logger.capture(held):
+        job.run()
+        logger.debug(
+            f"Finished {job.name} in {logger.format_duration(monotonic() - started)}"
+        )
+
+
+def run_jobs(
+    jobs: list[Job], concurrency: int, stop: Callable[[], object] | None = None
+):
+    """Run the jobs, up to `concurrency` at a time, starting each one once its dependencies are done.
+
+    Jobs start in the order they're given when they can, and their output is shown in that
+    order too: the first unfinished job's messages are shown as they happen and everything
+    later is held back until the jobs before it are done. Dependencies on jobs that aren't in
+    the list are ignored. If a job fails no more are started, `stop` is called to make the
+    running ones give up, and the first error is raised once they have. The same goes for
+    Ctrl-C, which is raised instead. With a concurrency of 1 the jobs run in this thread.
+    """
+    names = {job.name for job in jobs}
+    held = {job.name: logger.Capture() for job in jobs}
+    pending = list(jobs)
+    running: dict[Future, Job] = {}
+    done: set[str] = set()
+    shown = 0
+    failure: BaseException | None = None
+
+    if jobs:
+        logger.release(held[jobs[0].name])
+
+    executor: Executor = (
+        ThreadPoolExecutor(max_workers=concurrency)
+        if concurrency > 1
+        else _InlineExecutor()
+    )
+    try:
+        while pending or running:
+            for job in list(pending):
+                if failure is not None or len(running) >= concurrency:
+                    break
+                if all(name in done or name not in names for name in job.after):
+                    pending.remove(job)
+                    running[executor.submit(_run, job, held[job.name])] = job
+
+            if not running:
+                break  # only left with jobs that can't start
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                done.add(job.name)
+                if future.exception() is not None and failure is None:
+                    failure = future.exception()
+                    if stop is not None:
+                        stop()
+
+            while shown < len(jobs) and jobs[shown].name in done:
+                shown += 1
+                if shown < len(jobs):
+                    logger.release(held[jobs[shown].name])
+    except BaseException:
+        if stop is not None:
+            stop()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
+        for job in jobs[shown:]:
+            logger.release(held[job.name])
+
+    if failure is not None:
+        raise failure
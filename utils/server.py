@@ -0,0 +1,315 @@
+from functools import lru_cache
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from urllib.parse import parse_qs, unquote, urlparse
+
+from utils import file, logger
+from utils.resource import Resource
+
+
+# Most results the API returns in one go (and how many are returned by default)
+MAX_LIMIT = 100
+
+# URL the API is served under, and the one the image files are
+API_PATH = "/api/"
+UPLOADS_PATH = "/uploads/"
+
+# How many image galleries are kept in memory after being asked for
+GALLERY_CACHE_SIZE = 1024
+
+# The same status codes and messages as the original API
+ERRORS: dict[int, tuple[int, str]] = {
+    # status code -> (HTTP status, error)
+    101: (404, "Object Not Found"),
+    102: (404, "Error in URL Format"),
+    104: (400, "Filter Error"),
+}
+
+# Names used for a single item in detail URLs (e.g. /api/game/3030-4725/)
+SINGULAR_NAMES = {
+    "accessory": "accessories",
+    "character": "characters",
+    "chat": "chats",
+    "company": "companies",
+    "concept": "concepts",
+    "dlc": "dlcs",
+    "franchise": "franchises",
+    "game": "games",
+    "game_rating": "game_ratings",
+    "genre": "genres",
+    "image": "images",
+    "location": "locations",
+    "object": "objects",
+    "person": "people",
+    "platform": "platforms",
+    "promo": "promos",
+    "rating_board": "rating_boards",
+    "region": "regions",
+    "release": "releases",
+    "review": "reviews",
+    "theme": "themes",
+    "user_review": "user_reviews",
+    "video": "videos",
+    "video_category": "video_categories",
+    "video_show": "video_shows",
+    "video_type": "video_types",
+}
+
+
+class ApiRequestError(Exception):
+    """A request that the API would have answered with an error."""
+
+    def __init__(self, status_code: int):
+        super().__init__(ERRORS[status_code][1])
+        self.status_code = status_code
+
+
+class Index:
+    """A resource held in memory, with its items indexed by ID and GUID."""
+
+    def __init__(self, items: list):
+        self.items = [item for item in items if isinstance(item, dict)]
+        self.by_id = {item["id"]: item for item in self.items if "id" in item}
+        self.by_guid = {item["guid"]: item for item in self.items if "guid" in item}
+        self._sorted: dict[tuple[str, bool], list[dict]] = {}
+
+    def find(self, key: str) -> dict | None:
+        """Look up an item by its GUID or ID."""
+        if key in self.by_guid:
+            return self.by_guid[key]
+        if key.isdigit():
+            return self.by_id.get(int(key))
+        return None
+
+    def sorted(self, field: str, descending: bool) -> list[dict]:
+        """Get the items sorted by a field, with those missing it at the end (kept around,
+        since the same sorts come up a lot).
+        """
+        key = (field, descending)
+        if key not in self._sorted:
+            present = [item for item in self.items if item.get(field) is not None]
+            missing = [item for item in self.items if item.get(field) is None]
+            try:
+                present.sort(key=lambda item: item[field], reverse=descending)
+            except TypeError:
+                # Values that can't be compared, e.g. mixed types or objects
+                present.sort(key=lambda item: str(item[field]), reverse=descending)
+            self._sorted[key] = present + missing
+        return self._sorted[key]
+
+
+def _filter_items(items: list[dict], filters: str) -> list[dict]:
+    """Filter items like the API does, e.g. `name:mario,id:1|2|3`.
+
+    Text fields match if they contain any of the values (ignoring case), dates can be given
+    a `start|end` range, and anything else has to be equal to one of the values.
+    """
+    conditions = []
+    for condition in filters.split(","):
+        field, separator, value = condition.partition(":")
+        if not separator or not field:
+            raise ApiRequestError(104)
+        conditions.append((field, value.split("|")))
+
+    def matches(item: dict) -> bool:
+        for field, values in conditions:
+            value = item.get(field)
+            if value is None:
+                return False
+            if field.startswith("date_") and len(values) == 2:
+                if not values[0] <= str(value) <= values[1]:
+                    return False
+            elif isinstance(value, str):
+                if not any(v.lower() in value.lower() for v in values):
+                    return False
+            elif str(value) not in values:
+                return False
+        return True
+
+    return [item for item in items if matches(item)]
+
+
+def _int_param(params: dict[str, str], name: str, default: int) -> int:
+    """Get a whole number query parameter."""
+    try:
+        return max(int(params.get(name, default)), 0)
+    except ValueError:
+        raise ApiRequestError(102)
+
+
+def _trim(item: dict, field_list: list[str] | None) -> dict:
+    """Only keep the requested fields of an item."""
+    if not field_list:
+        return item
+    return {k: v for k, v in item.items() if k in field_list}
+
+
+@lru_cache(maxsize=GALLERY_CACHE_SIZE)
+def _load_gallery(base_path: str) -> Index | None:
+    """Load a downloaded image gallery."""
+    if file.find_data_file(base_path) is None:
+        return None
+    return Index(file.load_data(base_path))
+
+
+def load(root_dir: str) -> dict[str, Index]:
+    """Load every resource in the mirror into memory (image galleries are loaded when asked for)."""
+    indexes = {}
+    for resource in Resource:
+        path = file.find_data_file(os.path.join(root_dir, resource.value))
+        if path is None:
+            continue
+
+        indexes[resource.value] = Index(list(file.iter_data_file(path)))
+        logger.debug(f"Loaded {len(indexes[resource.value].items)} {resource.value}")
+
+    return indexes
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    """Answers API requests from memory and image requests from the uploads directory."""
+
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+    disable_nagle_algorithm = True  # otherwise small responses wait on the client's ACK
+    server: "Server"
+
+    def _api_response(self, path: str, params: dict[str, str]) -> dict:
+        """Work out the response to an API request, in the API's envelope."""
+        parts = [p for p in path[len(API_PATH) :].split("/") if p]
+        if not parts or len(parts) > 2:
+            raise ApiRequestError(102)
+
+        name = SINGULAR_NAMES.get(parts[0], parts[0])
+        field_list = None
+        if params.get("field_list"):
+            field_list = params["field_list"].split(",")
+
+        if name == Resource.IMAGES:
+            # Galleries are their own lists, e.g. /api/images/3030-4725/
+            if len(parts) != 2:
+                raise ApiRequestError(102)
+            index = _load_gallery(
+                os.path.join(self.server.root_dir, name, os.path.basename(parts[1]))
+            )
+            if index is None:
+                raise ApiRequestError(101)
+        else:
+            if name not in self.server.indexes:
+                raise ApiRequestError(102)
+            index = self.server.indexes[name]
+
+            if len(parts) == 2:
+                item = index.find(parts[1])
+                if item is None:
+                    raise ApiRequestError(101)
+                return {
+                    "limit": 1,
+                    "offset": 0,
+                    "number_of_page_results": 1,
+                    "number_of_total_results": 1,
+                    "results": _trim(item, field_list),
+                }
+
+        limit = min(_int_param(params, "limit", MAX_LIMIT), MAX_LIMIT)
+        offset = _int_param(params, "offset", 0)
+
+        items = index.items
+        if params.get("sort"):
+            field, _, direction = params["sort"].partition(":")
+            items = index.sorted(field, direction.lower() == "desc")
+        if params.get("filter"):
+            items = _filter_items(items, params["filter"])
+
+        results = [_trim(item, field_list) for item in items[offset : offset + limit]]
+        return {
+            "limit": limit,
+            "offset": offset,
+            "number_of_page_results": len(results),
+            "number_of_total_results": len(items),
+            "results": results,
+        }
+
+    def _send_json(self, status: int, data: dict):
+        """Send a JSON response."""
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith(UPLOADS_PATH):
+            return super().do_GET()
+        if not url.path.startswith(API_PATH):
+            return self.send_error(404)
+
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            response = {"error": "OK", "status_code": 1} | self._api_response(
+                unquote(url.path), params
+            )
+            status = 200
+        except ApiRequestError as error:
+            status = ERRORS[error.status_code][0]
+            response = {
+                "error": str(error),
+                "status_code": error.status_code,
+                "limit": 0,
+                "offset": 0,
+                "number_of_page_results": 0,
+                "number_of_total_results": 0,
+                "results": [],
+            }
+        except Exception as error:
+            # A bug rather than a bad request, so don't pass it off as one
+            logger.error(f"Unable to answer {self.path}: {error!r}")
+            return self.send_error(500)
+
+        self._send_json(status, response | {"version": "1.0"})
+
+    def do_HEAD(self):
+        if urlparse(self.path).path.startswith(UPLOADS_PATH):
+            return super().do_HEAD()
+        self.send_error(405)
+
+    def list_directory(self, path):
+        self.send_error(404)
+        return None
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def translate_path(self, path):
+        # Only ever called for /uploads/, which is the image directory
+        return super().translate_path("/" + path[len(UPLOADS_PATH) :])
+
+
+class Server(ThreadingHTTPServer):
+    """Serves a mirror the same way the API does."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], root_dir: str, image_dir: str):
+        self.root_dir = root_dir
+        self.indexes = load(root_dir)
+        super().__init__(
+            address,
+            lambda *args: _Handler(*args, directory=image_dir),
+        )
+
+
+def serve(root_dir: str, image_dir: str, host: str, port: int):
+    """Serve the mirror until interrupted."""
+    with Server((host, port), root_dir, image_dir) as server:
+        total = sum(len(index.items) for index in server.indexes.values())
+        logger.success(
+            f"Serving {len(server.indexes)} resources ({total} items) on http://{host}:{port}{API_PATH}"
+        )
+        logger.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Stopping...")
@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import mmap
+import os
+from typing import Iterator
+
+from utils import file, logger, pack
+from utils.manifest import Manifest
+
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for the zstd format
+    zstandard = None  # type: ignore
+
+
+# How many files to hand to the workers at a time
+BATCH_SIZE = 10000
+
+# How far from the end of a JPEG we look for its end marker (some have padding after it)
+JPEG_TAIL_SIZE = 1024
+
+# Extension added to files that fail verification (so they get downloaded again)
+CORRUPT_EXTENSION = ".corrupt"
+
+# Extensions of files that are expected to be images
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif", ".webp"]
+
+# Files which are left behind while something is being written
+PARTIAL_EXTENSIONS = [".tmp", ".part", CORRUPT_EXTENSION]
+
+# Errors raised when reading a data file that's been cut off or mangled
+DATA_ERRORS: tuple[type[Exception], ...] = (
+    OSError,
+    EOFError,
+    ValueError,
+    UnicodeDecodeError,
+) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def _check_image(data: mmap.mmap | bytes, path: str) -> str | None:
+    """Check the header and end of an image, returning what's wrong with it (if anything)."""
+    size = len(data)
+    if data[:3] == b"\xff\xd8\xff":
+        if b"\xff\xd9" not in data[max(size - JPEG_TAIL_SIZE, 0) :]:
+            return "JPEG is missing its end marker"
+        return None
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if b"IEND" not in data[-16:]:
+            return "PNG is missing its IEND chunk"
+        return None
+
+    if data[:6] in [b"GIF87a", b"GIF89a"]:
+        if not bytes(data[-16:]).rstrip(b"\x00").endswith(b";"):
+            return "GIF is missing its trailer"
+        return None
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        if int.from_bytes(data[4:8], "little") + 8 > size:
+            return "WebP is shorter than its header says"
+        return None
+
+    _, ext = os.path.splitext(path)
+    if ext.lower() in IMAGE_EXTENSIONS:
+        return "not a recognised image"
+
+    return None
+
+
+def _check_data_file(path: str) -> str | None:
+    """Check that a data file parses, returning the error if not."""
+    try:
+        for _ in file.iter_data_file(path):
+            pass
+    except DATA_ERRORS as error:
+        return str(error) or type(error).__name__
+
+    return None
+
+
+def _check_pack(path: str) -> list[int]:
+    """Check every gallery in a pack parses, returning the IDs of those that don't."""
+    current = pack.Pack(path)
+    if not current.index:
+        return []
+
+    broken = []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for gallery_id, (offset, length) in current.index.items():
+                try:
+                    json.loads(data[offset : offset + length])
+                except ValueError:
+                    broken.append(gallery_id)
+
+    return broken
+
+
+def _check_file_safely(path: str) -> tuple[str, dict]:
+    """Check a single file, treating anything that goes wrong as it being corrupt."""
+    try:
+        return _check_file(path)
+    except Exception as error:
+        return path, {"status": "corrupt", "error": str(error) or type(error).__name__}
+
+
+def _check_file(path: str) -> tuple[str, dict]:
+    """Hash and check a single file, returning its path and manifest entry."""
+    stat = os.stat(path)
+    entry: dict = {"size": stat.st_size, "mtime": stat.st_mtime}
+    error = None
+
+    if stat.st_size == 0:
+        entry["sha256"] = hashlib.sha256().hexdigest()
+        error = "empty file"
+    else:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                entry["sha256"] = hashlib.sha256(data).hexdigest()
+                if file.data_base(path) is None and not path.endswith(
+                    pack.PACK_EXTENSION
+                ):
+                    error = _check_image(data, path)
+
+    if error is None and file.data_base(path) is not None:
+        error = _check_data_file(path)
+
+    if error is None and path.endswith(pack.PACK_EXTENSION):
+        broken = _check_pack(path)
+        if broken:
+            entry["broken_galleries"] = broken
+            error = f"{len(broken)} galleries don't parse"
+
+    entry["status"] = "ok" if error is None else "corrupt"
+    if error is not None:
+        entry["error"] = error
+
+    return path, entry
+
+
+def _list_files(target_dir: str, image_dir: str) -> Iterator[str]:
+    """Go through every image and data file in the mirror."""
+    for dirpath, dirnames, filenames in os.walk(target_dir):
+        dirnames.sort()
+        in_images = os.path.commonpath([dirpath, image_dir]) == image_dir
+        for filename in sorted(filenames):
+            if any(filename.endswith(ext) for ext in PARTIAL_EXTENSIONS):
+                continue
+            if (
+                in_images
+                or file.data_base(filename) is not None
+                or filename.endswith(pack.PACK_EXTENSION)
+            ):
+                yield os.path.join(dirpath, filename)
+
+
+def _unchanged(manifest: Manifest, path: str) -> bool:
+    """Check whether a file already passed and hasn't changed since."""
+    entry = manifest.get(path)
+    if not entry or entry.get("status") != "ok":
+        return False
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False  # let the check report what's wrong with it
+    return entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime
+
+
+def verify(target_dir: str, image_dir: str, workers: int) -> tuple[int, int, list[str]]:
+    """Check every file in the mirror in parallel, recording checksums in the manifest.
+
+    Files that haven't changed since they last passed are skipped. Corrupt files are moved
+    aside (and corrupt galleries dropped from their packs) so they get downloaded again.
+    Returns how many files were checked and skipped, and the paths of the corrupt ones.
+    """
+    checked = 0
+    skipped = 0
+    corrupt: list[str] = []
+
+    with (
+        Manifest(target_dir) as manifest,
+        ThreadPoolExecutor(max_workers=workers) as executor,
+        logger.progress("Verifying") as progress,
+    ):
+        paths = _list_files(target_dir, image_dir)
+        while True:
+            batch = []
+            for path in paths:
+                if _unchanged(manifest, path):
+                    skipped += 1
+                    progress.advance()
+                    continue
+
+                batch.append(path)
+                if len(batch) >= BATCH_SIZE:
+                    break
+
+            if not batch:
+                break
+
+            for path, entry in executor.map(_check_file_safely, batch):
+                checked += 1
+                progress.advance()
+                manifest.update(path, **entry)
+                if entry["status"] == "ok":
+                    continue
+
+                logger.warn(f"Corrupt: {manifest.relative(path)} ({entry['error']})")
+                if "broken_galleries" in entry:
+                    current = pack.Pack(path)
+                    for gallery_id in entry["broken_galleries"]:
+                        current.discard(gallery_id)
+                else:
+                    if os.path.isfile(path):
+                        os.replace(path, path + CORRUPT_EXTENSION)
+                    manifest.remove(path)
+                corrupt.append(path)
+
+    return checked, skipped, corrupt